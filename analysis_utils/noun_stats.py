@@ -5,16 +5,16 @@ from collections import Counter
 import argparse
 import json
 import os
-import pickle
 import sys
 
 from tqdm import tqdm
 
 from utils import (
-    POS_TAGGED_CAPTIONS_FILENAME,
+    load_pos_tagged_captions,
     get_adjectives_for_noun,
     get_verbs_for_noun,
     get_objects_for_noun,
+    TaggedCaption,
 )
 
 
@@ -125,10 +125,7 @@ def noun_stats(nouns_files, preprocessed_data_folder):
         with open(nouns_file, "r") as json_file:
             nouns = json.load(json_file)
 
-        with open(
-            os.path.join(preprocessed_data_folder, POS_TAGGED_CAPTIONS_FILENAME), "rb"
-        ) as pickle_file:
-            captions = pickle.load(pickle_file)
+        captions = load_pos_tagged_captions(preprocessed_data_folder)
 
         first_noun = nouns[0]
 
@@ -143,6 +140,7 @@ def noun_stats(nouns_files, preprocessed_data_folder):
 
         for coco_id, tagged_caption in tqdm(captions.items()):
             for caption in tagged_caption["pos_tagged_captions"]:
+                caption = TaggedCaption(caption)
                 noun_is_present = False
                 for word in caption.words:
                     if word.lemma in nouns:
@@ -3,6 +3,7 @@
 import argparse
 import json
 import os
+import pickle
 import sys
 
 import h5py
@@ -23,6 +24,8 @@ from utils import (
     MODEL_BOTTOM_UP_TOP_DOWN,
     BOTTOM_UP_FEATURES_FILENAME,
     MODEL_BOTTOM_UP_TOP_DOWN_RANKING,
+    DATA_IMAGE_FEATURES,
+    BOTTOM_UP_FEATURES_INDICES_FILENAME,
 )
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -107,7 +110,14 @@ def load_model_and_calculate_score(checkpoint, data_folder, image_id, sequences)
         raise NotImplementedError()
 
     h5py_file = h5py.File(os.path.join(data_folder, image_features_file), "r")
-    image_data = h5py_file[image_id].value
+    if DATA_IMAGE_FEATURES in h5py_file:
+        with open(
+            os.path.join(data_folder, BOTTOM_UP_FEATURES_INDICES_FILENAME), "rb"
+        ) as pickle_file:
+            features_indices = pickle.load(pickle_file)
+        image_data = h5py_file[DATA_IMAGE_FEATURES][features_indices[image_id]]
+    else:
+        image_data = h5py_file[image_id].value
 
     if model_name == MODEL_SHOW_ATTEND_TELL:
         image_data = image_data / 255.0
@@ -3,7 +3,6 @@
 import argparse
 import json
 import os
-import pickle
 import sys
 
 from tqdm import tqdm
@@ -11,7 +10,7 @@ from tqdm import tqdm
 import numpy as np
 
 from utils import (
-    POS_TAGGED_CAPTIONS_FILENAME,
+    load_pos_tagged_captions,
     NOUNS,
     VERBS,
     PAIR_OCCURENCES,
@@ -19,14 +18,12 @@ from utils import (
     get_verbs_for_noun,
     get_objects_for_noun,
     get_objects_for_verb,
+    TaggedCaption,
 )
 
 
 def noun_stats(preprocessed_data_folder):
-    with open(
-        os.path.join(preprocessed_data_folder, POS_TAGGED_CAPTIONS_FILENAME), "rb"
-    ) as pickle_file:
-        captions = pickle.load(pickle_file)
+    captions = load_pos_tagged_captions(preprocessed_data_folder)
 
     pairs_with_transitive_verbs = ["eat_horse", "hold_child", "ride_woman", "eat_man"]
     pairs_with_intransitive_verbs = [
@@ -56,6 +53,7 @@ def noun_stats(preprocessed_data_folder):
         for coco_id in tqdm(matching_images_ids):
             tagged_captions = captions[coco_id]
             for caption in tagged_captions["pos_tagged_captions"]:
+                caption = TaggedCaption(caption)
                 noun_is_present = False
                 verb_is_present = False
                 for word in caption.words:
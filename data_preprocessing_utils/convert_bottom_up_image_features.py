@@ -12,56 +12,162 @@ from __future__ import print_function
 
 import argparse
 import os
+import pickle
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 from tqdm import tqdm
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-import base64
 import csv
 import h5py
 import numpy as np
 
+try:
+    # SIMD-accelerated decoder, decoding is the bottleneck of the conversion
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+from utils import (
+    BOTTOM_UP_FEATURES_FILENAME,
+    BOTTOM_UP_FEATURES_INDICES_FILENAME,
+    DATA_IMAGE_FEATURES,
+    DATA_IMAGE_BB,
+)
+
 csv.field_size_limit(sys.maxsize)
 
-FIELDNAMES = ["image_id", "image_w", "image_h", "num_boxes", "boxes", "features"]
+# Columns of the TSV files: image_id, image_w, image_h, num_boxes, boxes, features
 
 feature_length = 2048
 
+# The features of all images are stored in one dataset, so only the features with a
+# fixed number of boxes per image (e.g. trainval_36) can be converted, not the
+# adaptive ones with 10 to 100 boxes
+num_fixed_boxes = 36
+
+# Number of images that are decoded and written to the HDF5 file at once
+write_buffer_size = 64
+
+# Size of the read buffer for the TSV files (in bytes), every row is several hundred KB
+read_buffer_size = 16 * 1024 * 1024
+
+# Number of threads that decode the features while the TSV files are being read
+num_decode_workers = 4
+
+
+def decode_row(row):
+    """Decode the features and bounding boxes of a TSV row."""
+    image_id, _, _, num_boxes, boxes, features = row
+    num_boxes = int(num_boxes)
+    assert num_boxes == num_fixed_boxes, (
+        "Image {} has {} boxes, but only features with a fixed number of {} boxes per "
+        "image can be converted".format(image_id, num_boxes, num_fixed_boxes)
+    )
+
+    image_features = np.frombuffer(
+        base64.b64decode(features), dtype=np.float32
+    ).reshape((num_boxes, -1))
+    image_bb = np.frombuffer(base64.b64decode(boxes), dtype=np.float32).reshape(
+        (num_boxes, -1)
+    )
+    return image_features, image_bb
+
+
+def read_chunks(reader, image_id_to_index):
+    """Yield chunks of rows of images that have not been seen yet and assign their indices."""
+    chunk = []
+    for row in reader:
+        image_id = row[0]
+        if image_id in image_id_to_index:
+            continue
+
+        image_id_to_index[image_id] = len(image_id_to_index)
+        chunk.append(row)
+        if len(chunk) == write_buffer_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def write(features_dataset, bb_dataset, decoded_rows):
+    """Append decoded features and bounding boxes to the HDF5 datasets."""
+    features, bbs = zip(*decoded_rows)
+    start = features_dataset.shape[0]
+    end = start + len(features)
+
+    features_dataset.resize(end, axis=0)
+    bb_dataset.resize(end, axis=0)
+    features_dataset[start:end] = np.stack(features)
+    bb_dataset[start:end] = np.stack(bbs)
+
 
 def convert(base_dir):
-    output_filename = "features.hdf5"
+    output_filename = BOTTOM_UP_FEATURES_FILENAME
     print("Saving features to {}".format(output_filename))
-    output_file = h5py.File(output_filename, "w")
-    count = 0
-
-    for directory in os.listdir(base_dir):
-        input_file = os.path.join(base_dir, directory)
-        if os.path.isfile(input_file):
-            print("Reading tsv: ", input_file)
-            with open(input_file, "rt") as tsv_in_file:
-                reader = csv.DictReader(
-                    tsv_in_file, delimiter="\t", fieldnames=FIELDNAMES
-                )
-                for item in tqdm(reader):
-                    image_id = item["image_id"]
-                    item["num_boxes"] = int(item["num_boxes"])
-
-                    image_features = np.frombuffer(
-                        base64.b64decode(item["features"]), dtype=np.float32
-                    ).reshape((item["num_boxes"], -1))
-                    if image_id not in output_file:
-                        output_file.create_dataset(
-                            image_id,
-                            (item["num_boxes"], feature_length),
-                            dtype="f",
-                            data=image_features,
-                        )
-                        count += 1
+
+    # Enlarge the raw chunk cache, as we're writing many chunks in sequence
+    output_file = h5py.File(
+        output_filename,
+        "w",
+        libver="latest",
+        rdcc_nbytes=64 << 20,
+        rdcc_nslots=int(1e6),
+    )
+
+    # Store all images in two contiguous datasets instead of one dataset per image.
+    # Every image is stored in its own compressed chunk (~288KB uncompressed), as
+    # the features are read one image at a time during training.
+    features_dataset = output_file.create_dataset(
+        DATA_IMAGE_FEATURES,
+        (0, num_fixed_boxes, feature_length),
+        maxshape=(None, num_fixed_boxes, feature_length),
+        dtype="f4",
+        chunks=(1, num_fixed_boxes, feature_length),
+        compression="lzf",
+        shuffle=True,
+    )
+    bb_dataset = output_file.create_dataset(
+        DATA_IMAGE_BB,
+        (0, num_fixed_boxes, 4),
+        maxshape=(None, num_fixed_boxes, 4),
+        dtype="f4",
+        chunks=(write_buffer_size, num_fixed_boxes, 4),
+    )
+
+    image_id_to_index = {}
+
+    with ThreadPoolExecutor(max_workers=num_decode_workers) as executor:
+        for directory in os.listdir(base_dir):
+            input_file = os.path.join(base_dir, directory)
+            if os.path.isfile(input_file):
+                print("Reading tsv: ", input_file)
+                with open(
+                    input_file, "rt", buffering=read_buffer_size, newline=""
+                ) as tsv_in_file:
+                    reader = csv.reader(tsv_in_file, delimiter="\t")
+
+                    # Decode a chunk in the background while the next one is read,
+                    # the results are returned in order of the rows
+                    pending_rows = None
+                    for chunk in read_chunks(tqdm(reader), image_id_to_index):
+                        decoded_rows = executor.map(decode_row, chunk)
+                        if pending_rows is not None:
+                            write(features_dataset, bb_dataset, pending_rows)
+                        pending_rows = decoded_rows
+                    if pending_rows is not None:
+                        write(features_dataset, bb_dataset, pending_rows)
 
     output_file.close()
-    print("Converted features for {} images".format(count))
+
+    print("Saving feature indices to {}".format(BOTTOM_UP_FEATURES_INDICES_FILENAME))
+    with open(BOTTOM_UP_FEATURES_INDICES_FILENAME, "wb") as pickle_file:
+        pickle.dump(image_id_to_index, pickle_file)
+
+    print("Converted features for {} images".format(len(image_id_to_index)))
 
 
 def check_args(args):
@@ -2,9 +2,9 @@
 import argparse
 import json
 import os
-import pickle
 import sys
 
+import numpy as np
 from tqdm import tqdm
 
 from utils import (
@@ -16,10 +16,11 @@ from utils import (
     contains_adjective_noun_pair,
     OCCURRENCE_DATA,
     DATA_COCO_SPLIT,
-    POS_TAGGED_CAPTIONS_FILENAME,
+    load_pos_tagged_captions,
     VERBS,
     contains_verb_noun_pair,
     VERB_OCCURRENCES,
+    TaggedCaption,
 )
 
 
@@ -30,10 +31,7 @@ def count_adjective_noun_pairs(nouns_file, adjectives_file, preprocessed_data_fo
     with open(adjectives_file, "r") as json_file:
         adjectives = json.load(json_file)
 
-    with open(
-        os.path.join(preprocessed_data_folder, POS_TAGGED_CAPTIONS_FILENAME), "rb"
-    ) as pickle_file:
-        captions = pickle.load(pickle_file)
+    captions = load_pos_tagged_captions(preprocessed_data_folder)
 
     first_noun = nouns[0]
     first_adjective = adjectives[0]
@@ -54,6 +52,7 @@ def count_adjective_noun_pairs(nouns_file, adjectives_file, preprocessed_data_fo
         occurrence_data[coco_id][DATA_COCO_SPLIT] = tagged_caption[DATA_COCO_SPLIT]
 
         for caption in tagged_caption["pos_tagged_captions"]:
+            caption = TaggedCaption(caption)
             noun_is_present, adjective_is_present, combination_is_present = contains_adjective_noun_pair(
                 caption, nouns, adjectives
             )
@@ -72,32 +71,7 @@ def count_adjective_noun_pairs(nouns_file, adjectives_file, preprocessed_data_fo
     with open(data_path, "w") as json_file:
         json.dump(data, json_file)
 
-    for n in range(1, 6):
-        noun_occurences = len(
-            [d for d in occurrence_data.values() if d[NOUN_OCCURRENCES] >= n]
-        )
-        adjective_occurences = len(
-            [d for d in occurrence_data.values() if d[ADJECTIVE_OCCURRENCES] >= n]
-        )
-        pair_occurences = len(
-            [d for d in occurrence_data.values() if d[PAIR_OCCURENCES] >= n]
-        )
-
-        print(
-            "\nFound {}\timages where the noun occurs at least {} time(s).".format(
-                noun_occurences, n
-            )
-        )
-        print(
-            "Found {}\timages where the adjective occurs at least {} time(s).".format(
-                adjective_occurences, n
-            )
-        )
-        print(
-            "Found {}\timages where the pair occurs at least {} time(s).".format(
-                pair_occurences, n
-            )
-        )
+    print_occurrence_statistics(occurrence_data, ADJECTIVE_OCCURRENCES, "adjective")
 
 
 def count_verb_noun_pairs(nouns_file, verbs_file, preprocessed_data_folder):
@@ -107,10 +81,7 @@ def count_verb_noun_pairs(nouns_file, verbs_file, preprocessed_data_folder):
     with open(verbs_file, "r") as json_file:
         verbs = json.load(json_file)
 
-    with open(
-        os.path.join(preprocessed_data_folder, POS_TAGGED_CAPTIONS_FILENAME), "rb"
-    ) as pickle_file:
-        captions = pickle.load(pickle_file)
+    captions = load_pos_tagged_captions(preprocessed_data_folder)
 
     first_noun = nouns[0]
     first_verb = verbs[0]
@@ -131,6 +102,7 @@ def count_verb_noun_pairs(nouns_file, verbs_file, preprocessed_data_folder):
         occurrence_data[coco_id][DATA_COCO_SPLIT] = tagged_caption[DATA_COCO_SPLIT]
 
         for caption in tagged_caption["pos_tagged_captions"]:
+            caption = TaggedCaption(caption)
             noun_is_present, verb_is_present, combination_is_present = contains_verb_noun_pair(
                 caption, nouns, verbs
             )
@@ -149,15 +121,22 @@ def count_verb_noun_pairs(nouns_file, verbs_file, preprocessed_data_folder):
     with open(data_path, "w") as json_file:
         json.dump(data, json_file)
 
+    print_occurrence_statistics(occurrence_data, VERB_OCCURRENCES, "verb")
+
+
+def print_occurrence_statistics(occurrence_data, other_occurrences_key, other_name):
+    # Collect all counts in one pass, columns: noun, adjective/verb, pair
+    occurrences = np.array(
+        [
+            [d[NOUN_OCCURRENCES], d[other_occurrences_key], d[PAIR_OCCURENCES]]
+            for d in occurrence_data.values()
+        ],
+        dtype=np.int32,
+    ).reshape(-1, 3)
+
     for n in range(1, 6):
-        noun_occurences = len(
-            [d for d in occurrence_data.values() if d[NOUN_OCCURRENCES] >= n]
-        )
-        verb_occurences = len(
-            [d for d in occurrence_data.values() if d[VERB_OCCURRENCES] >= n]
-        )
-        pair_occurences = len(
-            [d for d in occurrence_data.values() if d[PAIR_OCCURENCES] >= n]
+        noun_occurences, other_occurences, pair_occurences = (occurrences >= n).sum(
+            axis=0
         )
 
         print(
@@ -166,8 +145,8 @@ def count_verb_noun_pairs(nouns_file, verbs_file, preprocessed_data_folder):
             )
         )
         print(
-            "Found {}\timages where the verb occurs at least {} time(s).".format(
-                verb_occurences, n
+            "Found {}\timages where the {} occurs at least {} time(s).".format(
+                other_occurences, other_name, n
             )
         )
         print(
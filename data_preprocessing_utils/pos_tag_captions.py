@@ -17,13 +17,17 @@ from utils import (
     DATA_CAPTIONS,
     DATA_COCO_SPLIT,
     POS_TAGGED_CAPTIONS_FILENAME,
+    pos_tag_captions,
+    compact_pos_tagged_caption,
 )
 
 # stanfordnlp.download('en', confirm_if_exists=True)
 
 
 def count_adjective_noun_pairs(preprocessed_data_folder):
-    nlp_pipeline = stanfordnlp.Pipeline()
+    nlp_pipeline = stanfordnlp.Pipeline(
+        processors="tokenize,pos,lemma,depparse", tokenize_pretokenized=True
+    )
 
     with open(
         os.path.join(preprocessed_data_folder, IMAGES_META_FILENAME), "r"
@@ -40,22 +44,18 @@ def count_adjective_noun_pairs(preprocessed_data_folder):
         encoded_captions = image_meta[DATA_CAPTIONS]
 
         decoded_captions = [
-            " ".join(
-                decode_caption(
-                    get_caption_without_special_tokens(caption, word_map), word_map
-                )
+            decode_caption(
+                get_caption_without_special_tokens(caption, word_map), word_map
             )
             for caption in encoded_captions
         ]
 
         data[coco_id] = {}
         data[coco_id][DATA_COCO_SPLIT] = image_meta[DATA_COCO_SPLIT]
-        data[coco_id]["pos_tagged_captions"] = []
-
-        for caption in decoded_captions:
-            doc = nlp_pipeline(caption)
-            sentence = doc.sentences[0]
-            data[coco_id]["pos_tagged_captions"].append(sentence)
+        data[coco_id]["pos_tagged_captions"] = [
+            compact_pos_tagged_caption(sentence)
+            for sentence in pos_tag_captions(nlp_pipeline, decoded_captions)
+        ]
 
     data_path = os.path.join(preprocessed_data_folder, POS_TAGGED_CAPTIONS_FILENAME)
     print("\nSaving results to {}".format(data_path))
@@ -1,12 +1,25 @@
 """PyTorch dataset classes for the image captioning training and testing datasets"""
 
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, default_collate
 import h5py
 import json
 import os
+import pickle
 
-from utils import IMAGES_META_FILENAME, DATA_CAPTIONS, DATA_CAPTION_LENGTHS
+from utils import (
+    IMAGES_META_FILENAME,
+    DATA_CAPTIONS,
+    DATA_CAPTION_LENGTHS,
+    DATA_IMAGE_FEATURES,
+    BOTTOM_UP_FEATURES_INDICES_FILENAME,
+)
+
+
+def load_images_meta(data_folder):
+    """Load the image meta data, including the captions of all images."""
+    with open(os.path.join(data_folder, IMAGES_META_FILENAME), "r") as json_file:
+        return json.load(json_file)
 
 
 class CaptionDataset(Dataset):
@@ -21,6 +34,7 @@ class CaptionDataset(Dataset):
         split,
         normalize=None,
         features_scale_factor=1,
+        images_meta=None,
     ):
         """
         :param data_folder: folder where data files are stored
@@ -28,17 +42,27 @@ class CaptionDataset(Dataset):
         :param split: split, indices of images that should be included
         :param normalize: PyTorch normalization transformation
         :param features_scale_factor: Additional scale factor, applied before normalization
+        :param images_meta: Image meta data, loaded from the data folder if None
         """
         self.image_features = h5py.File(
             os.path.join(data_folder, features_filename), "r"
         )
 
+        # Features that are stored in a single dataset are looked up by their index
+        self.features_indices = None
+        if DATA_IMAGE_FEATURES in self.image_features:
+            with open(
+                os.path.join(data_folder, BOTTOM_UP_FEATURES_INDICES_FILENAME), "rb"
+            ) as pickle_file:
+                self.features_indices = pickle.load(pickle_file)
+
         self.split = split
         self.features_scale_factor = features_scale_factor
 
         # Load image meta data, including captions
-        with open(os.path.join(data_folder, IMAGES_META_FILENAME), "r") as json_file:
-            self.images_meta = json.load(json_file)
+        if images_meta is None:
+            images_meta = load_images_meta(data_folder)
+        self.images_meta = images_meta
 
         self.captions_per_image = len(
             next(iter(self.images_meta.values()))[DATA_CAPTIONS]
@@ -51,7 +75,12 @@ class CaptionDataset(Dataset):
         self.dataset_size = len(self.split)
 
     def get_image_features(self, coco_id):
-        image_data = self.image_features[coco_id][()]
+        if self.features_indices is not None:
+            image_data = self.image_features[DATA_IMAGE_FEATURES][
+                self.features_indices[coco_id]
+            ]
+        else:
+            image_data = self.image_features[coco_id][()]
 
         # scale the features with given factor
         image_data = image_data * self.features_scale_factor
@@ -104,11 +133,113 @@ class CaptionTestDataset(CaptionDataset):
         coco_id = self.split[i]
 
         image = self.get_image_features(coco_id)
+        all_captions_for_image, caption_lengths = self.get_captions(coco_id)
+
+        return image, all_captions_for_image, caption_lengths, coco_id
+
+    def get_captions(self, coco_id):
         all_captions_for_image = torch.LongTensor(
             self.images_meta[coco_id][DATA_CAPTIONS]
         )
         caption_lengths = torch.LongTensor(
             self.images_meta[coco_id][DATA_CAPTION_LENGTHS]
         )
+        return all_captions_for_image, caption_lengths
 
-        return image, all_captions_for_image, caption_lengths, coco_id
+
+class CachedFeaturesTestDataset(Dataset):
+    """
+    PyTorch test dataset that provides precomputed encoder outputs instead of the images
+    of a test dataset, along with all their corresponding captions.
+    """
+
+    def __init__(self, dataset, encoder_outputs):
+        """
+        :param dataset: test dataset of the images
+        :param encoder_outputs: encoder outputs for all images of the dataset, in the
+            order of the dataset
+        """
+        self.dataset = dataset
+        self.encoder_outputs = encoder_outputs
+
+    def __getitem__(self, i):
+        coco_id = self.dataset.split[i]
+        all_captions_for_image, caption_lengths = self.dataset.get_captions(coco_id)
+
+        return self.encoder_outputs[i], all_captions_for_image, caption_lengths, coco_id
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def collate_decode_lengths(batch):
+    """
+    Collate a batch of the training dataset and replace the caption lengths by the
+    decode lengths, which don't include the <start> token.
+
+    :param batch: list of samples of a CaptionTrainDataset
+    :return: images, captions, decode lengths, shape: (batch_size)
+    """
+    images, captions, caption_lengths = default_collate(batch)
+    return images, captions, caption_lengths.squeeze(1) - 1
+
+
+class DevicePrefetcher(object):
+    """
+    Iterates over a data loader and moves the tensors of every batch to the device. On
+    CUDA devices, the batches are copied in a separate stream, one batch ahead, so that
+    the copy of the next batch overlaps with processing the current batch.
+    """
+
+    def __init__(self, data_loader, device):
+        """
+        :param data_loader: data loader, should use pinned memory for asynchronous copies
+        :param device: device to move the tensors to
+        """
+        self.data_loader = data_loader
+        self.device = device
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def move_to_device(self, batch):
+        return [
+            item.to(self.device, non_blocking=True)
+            if isinstance(item, torch.Tensor)
+            else item
+            for item in batch
+        ]
+
+    def wait_for_copy(self, copy_stream, batch):
+        """Make the current stream wait until the batch has been copied."""
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_stream(copy_stream)
+
+        # The tensors were allocated in the copy stream, but are used in the current one
+        for item in batch:
+            if isinstance(item, torch.Tensor):
+                item.record_stream(current_stream)
+        return batch
+
+    def __iter__(self):
+        if self.device.type != "cuda":
+            for batch in self.data_loader:
+                yield self.move_to_device(batch)
+            return
+
+        copy_stream = torch.cuda.Stream(self.device)
+        prefetched_batch = None
+        for batch in self.data_loader:
+            if prefetched_batch is not None:
+                self.wait_for_copy(copy_stream, prefetched_batch)
+
+            # Start copying the next batch before the prefetched batch is processed
+            with torch.cuda.stream(copy_stream):
+                next_batch = self.move_to_device(batch)
+
+            if prefetched_batch is not None:
+                yield prefetched_batch
+            prefetched_batch = next_batch
+
+        if prefetched_batch is not None:
+            yield self.wait_for_copy(copy_stream, prefetched_batch)
@@ -10,12 +10,9 @@ import torch.optim
 import torch.utils.data
 import torchvision.transforms as transforms
 from datasets import *
-from metrics import recall_pairs, beam_occurrences
-from nltk.translate.bleu_score import corpus_bleu
+from metrics import recall_pairs, beam_occurrences, corpus_bleu_parallel
 from tqdm import tqdm
 
-import numpy as np
-
 from utils import (
     get_caption_without_special_tokens,
     IMAGENET_IMAGES_MEAN,
@@ -39,10 +36,12 @@ METRIC_RECALL = "recall"
 METRIC_BEAM_OCCURRENCES = "beam-occurrences"
 
 
-def get_top_ranked_captions_indices(embedded_image, embedded_captions):
+def get_top_ranked_captions_indices(embedded_image, embedded_captions, k):
     # Compute similarity of image to all captions
-    d = np.dot(embedded_image, embedded_captions.T).flatten()
-    inds = np.argsort(d)[::-1]
+    d = embedded_image.mm(embedded_captions.t()).view(-1)
+
+    # Only the k best captions are needed, so a partial selection is sufficient
+    _, inds = d.topk(min(k, d.size(0)), largest=True, sorted=True)
     return inds
 
 
@@ -52,6 +51,7 @@ def re_rank_beam(
     encoded_features,
     word_map,
     coco_id,
+    eval_beam_size,
     print_captions,
 ):
     if print_captions:
@@ -79,13 +79,14 @@ def re_rank_beam(
     image_embedded, image_captions_embedded = decoder.forward_ranking(
         encoded_features, top_k_generated_captions, torch.tensor(lengths, device=device)
     )
-    image_embedded = image_embedded.detach().cpu().numpy()[0]
-    image_captions_embedded = image_captions_embedded.detach().cpu().numpy()
 
-    indices = get_top_ranked_captions_indices(image_embedded, image_captions_embedded)
-    top_k_generated_captions = [top_k_generated_captions[i] for i in indices]
+    # Rank on the device and copy the re-ordered captions back in one transfer
+    indices = get_top_ranked_captions_indices(
+        image_embedded, image_captions_embedded, eval_beam_size
+    )
+    top_k_generated_captions = top_k_generated_captions[indices].cpu().numpy()
 
-    return [caption.cpu().numpy() for caption in top_k_generated_captions]
+    return list(top_k_generated_captions)
 
 
 def evaluate(
@@ -100,6 +101,8 @@ def evaluate(
     visualize,
     print_beam,
     print_captions,
+    batch_size=1,
+    compile_decoder=False,
 ):
     # Load model
     checkpoint = torch.load(checkpoint_path, map_location=device)
@@ -116,6 +119,8 @@ def evaluate(
     decoder = decoder.to(device)
     word_map = decoder.word_map
     decoder.eval()
+    if compile_decoder:
+        decoder.compile_forward_step()
 
     logging.info("Decoder params: {}".format(decoder.params))
 
@@ -129,108 +134,136 @@ def evaluate(
             mean=IMAGENET_IMAGES_MEAN, std=IMAGENET_IMAGES_STD
         )
 
-        # DataLoader
-        data_loader = torch.utils.data.DataLoader(
-            CaptionTestDataset(
-                data_folder,
-                IMAGES_FILENAME,
-                test_images_split,
-                transforms.Compose([normalize]),
-                features_scale_factor=1 / 255.0,
-            ),
-            batch_size=1,
-            shuffle=True,
-            num_workers=1,
-            pin_memory=True,
+        dataset = CaptionTestDataset(
+            data_folder,
+            IMAGES_FILENAME,
+            test_images_split,
+            transforms.Compose([normalize]),
+            features_scale_factor=1 / 255.0,
         )
     elif (
         model_name == MODEL_BOTTOM_UP_TOP_DOWN
         or model_name == MODEL_BOTTOM_UP_TOP_DOWN_RANKING
     ):
-        data_loader = torch.utils.data.DataLoader(
-            CaptionTestDataset(
-                data_folder, BOTTOM_UP_FEATURES_FILENAME, test_images_split
-            ),
-            batch_size=1,
-            shuffle=True,
-            num_workers=1,
-            pin_memory=True,
+        dataset = CaptionTestDataset(
+            data_folder, BOTTOM_UP_FEATURES_FILENAME, test_images_split
         )
     else:
         raise RuntimeError("Unknown model name: {}".format(model_name))
 
-    # Lists for target captions and generated captions for each image
-    target_captions = {}
-    generated_captions = {}
-    generated_beams = {}
+    store_beam = True if METRIC_BEAM_OCCURRENCES in metrics else False
 
-    for image_features, all_captions_for_image, caption_lengths, coco_id in tqdm(
-        data_loader, desc="Evaluate with beam size " + str(beam_size)
-    ):
-        coco_id = coco_id[0]
-
-        # Target captions
-        target_captions[coco_id] = [
-            get_caption_without_special_tokens(caption, word_map)
-            for caption in all_captions_for_image[0].tolist()
-        ]
+    # Several images can be decoded at once with beam search if the beams and
+    # attention weights of the single images are not needed
+    if nucleus_sampling or visualize or store_beam or print_beam:
+        batch_size = 1
 
-        # Generate captions
-        encoded_features = image_features.to(device)
-        if encoder:
-            encoded_features = encoder(encoded_features)
-
-        store_beam = True if METRIC_BEAM_OCCURRENCES in metrics else False
-
-        if nucleus_sampling:
-            top_k_generated_captions, alphas, beam = decoder.nucleus_sampling(
-                encoded_features,
-                beam_size,
-                top_p=nucleus_sampling,
-                print_beam=print_beam,
-            )
-        else:
-            top_k_generated_captions, alphas, beam = decoder.beam_search(
-                encoded_features,
-                beam_size,
-                store_alphas=visualize,
-                store_beam=store_beam,
-                print_beam=print_beam,
-            )
+    # DataLoader
+    data_loader = torch.utils.data.DataLoader(
+        dataset, batch_size=batch_size, shuffle=False, num_workers=1, pin_memory=True
+    )
 
-        if visualize:
-            logging.info("Image COCO ID: {}".format(coco_id))
-            for caption, alpha in zip(top_k_generated_captions, alphas):
-                visualize_attention(
-                    image_features.squeeze(0), caption, alpha, word_map, smoothen=True
-                )
+    if encoder:
+        # All images have the same size, so the encoder can be traced once with an example image.
+        # The encoder is not captured in a CUDA graph, it runs once per batch and the
+        # decoding time is dominated by the beam search, whose tensor shapes change in
+        # every step
+        example_image = dataset[0][0].unsqueeze(0).to(device)
+        with torch.inference_mode():
+            encoder = torch.jit.trace(encoder, example_image)
 
-        if re_ranking:
-            top_k_generated_captions = re_rank_beam(
-                decoder,
-                top_k_generated_captions,
-                encoded_features,
-                word_map,
-                coco_id,
-                print_captions,
-            )
+    # Lists for target captions and generated captions for each image
+    target_captions = {}
+    generated_captions = {}
+    generated_beams = {}
 
-        generated_captions[coco_id] = top_k_generated_captions[:eval_beam_size]
-        if print_captions:
-            logging.info("COCO ID: {}".format(coco_id))
-            for caption in generated_captions[coco_id]:
-                logging.info(
-                    " ".join(
-                        decode_caption(
-                            get_caption_without_special_tokens(caption, word_map),
+    # Disable gradient computation and the version tracking of tensors, we only run
+    # inference
+    with torch.inference_mode():
+        for image_features, all_captions_for_images, caption_lengths, coco_ids in tqdm(
+            data_loader, desc="Evaluate with beam size " + str(beam_size)
+        ):
+            # Generate captions
+            encoded_features = image_features.to(device, non_blocking=True)
+            if encoder:
+                encoded_features = encoder(encoded_features)
+
+            if batch_size > 1:
+                outputs = [
+                    (top_k_generated_captions, None, None)
+                    for top_k_generated_captions in decoder.batched_beam_search(
+                        encoded_features, beam_size
+                    )
+                ]
+            elif nucleus_sampling:
+                outputs = [
+                    decoder.nucleus_sampling(
+                        encoded_features,
+                        beam_size,
+                        top_p=nucleus_sampling,
+                        print_beam=print_beam,
+                    )
+                ]
+            else:
+                outputs = [
+                    decoder.beam_search(
+                        encoded_features,
+                        beam_size,
+                        store_alphas=visualize,
+                        store_beam=store_beam,
+                        print_beam=print_beam,
+                    )
+                ]
+
+            for j, (top_k_generated_captions, alphas, beam) in enumerate(outputs):
+                coco_id = coco_ids[j]
+
+                # Target captions
+                target_captions[coco_id] = [
+                    get_caption_without_special_tokens(caption, word_map)
+                    for caption in all_captions_for_images[j].tolist()
+                ]
+
+                if visualize:
+                    logging.info("Image COCO ID: {}".format(coco_id))
+                    for caption, alpha in zip(top_k_generated_captions, alphas):
+                        visualize_attention(
+                            image_features[j],
+                            caption,
+                            alpha,
                             word_map,
+                            smoothen=True,
                         )
+
+                if re_ranking:
+                    top_k_generated_captions = re_rank_beam(
+                        decoder,
+                        top_k_generated_captions,
+                        encoded_features[j : j + 1],
+                        word_map,
+                        coco_id,
+                        eval_beam_size,
+                        print_captions,
                     )
-                )
-        if store_beam:
-            generated_beams[coco_id] = beam
 
-        assert len(target_captions) == len(generated_captions)
+                generated_captions[coco_id] = top_k_generated_captions[:eval_beam_size]
+                if print_captions:
+                    logging.info("COCO ID: {}".format(coco_id))
+                    for caption in generated_captions[coco_id]:
+                        logging.info(
+                            " ".join(
+                                decode_caption(
+                                    get_caption_without_special_tokens(
+                                        caption, word_map
+                                    ),
+                                    word_map,
+                                )
+                            )
+                        )
+                if store_beam:
+                    generated_beams[coco_id] = beam
+
+                assert len(target_captions) == len(generated_captions)
 
     # Save results
     name = str(os.path.basename(checkpoint_path).split(".")[0])
@@ -282,17 +315,17 @@ def calculate_metric(
             for top_k_captions in generated_captions.values()
         ]
         target_captions = target_captions.values()
-        bleu_1 = corpus_bleu(target_captions, generated_captions, weights=(1, 0, 0, 0))
-        bleu_2 = corpus_bleu(
-            target_captions, generated_captions, weights=(0.5, 0.5, 0, 0)
-        )
-        bleu_3 = corpus_bleu(
-            target_captions, generated_captions, weights=(0.33, 0.33, 0.33, 0)
-        )
-        bleu_4 = corpus_bleu(
-            target_captions, generated_captions, weights=(0.25, 0.25, 0.25, 0.25)
+        # The n-gram statistics are collected once for BLEU-1 to BLEU-4
+        bleu_scores = corpus_bleu_parallel(
+            target_captions,
+            generated_captions,
+            weights=[
+                (1, 0, 0, 0),
+                (0.5, 0.5, 0, 0),
+                (0.33, 0.33, 0.33, 0),
+                (0.25, 0.25, 0.25, 0.25),
+            ],
         )
-        bleu_scores = [bleu_1, bleu_2, bleu_3, bleu_4]
         bleu_scores = [float("%.2f" % elem) for elem in bleu_scores]
         logging.info("\nBLEU score @ beam size {} is {}".format(beam_size, bleu_scores))
     elif metric_name == METRIC_RECALL:
@@ -361,12 +394,24 @@ def check_args(args):
         default=False,
         action="store_true",
     )
+    parser.add_argument(
+        "--batch-size",
+        help="Number of images that are decoded at once with beam search",
+        type=int,
+        default=1,
+    )
     parser.add_argument(
         "--print-captions",
         help="Print the generated captions for every sample",
         default=False,
         action="store_true",
     )
+    parser.add_argument(
+        "--compile",
+        help="Compile the forward step of the decoder with torch.compile",
+        dest="compile_decoder",
+        action="store_true",
+    )
 
     parsed_args = parser.parse_args(args)
     return parsed_args
@@ -393,4 +438,6 @@ if __name__ == "__main__":
         visualize=parsed_args.visualize_attention,
         print_beam=parsed_args.print_beam,
         print_captions=parsed_args.print_captions,
+        batch_size=parsed_args.batch_size,
+        compile_decoder=parsed_args.compile_decoder,
     )
@@ -1,15 +1,26 @@
 """Metrics for the image captioning task"""
 
+import contextlib
 import json
 import logging
+import math
+import multiprocessing
 import os
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from fractions import Fraction
 
 import matplotlib.pyplot as plt
 
 import stanfordnlp
 
 import numpy as np
+from nltk.translate.bleu_score import (
+    brevity_penalty,
+    closest_ref_length,
+    modified_precision,
+    SmoothingFunction,
+)
 from utils import (
     decode_caption,
     NOUNS,
@@ -23,22 +34,36 @@ from utils import (
     get_splits_from_occurrences_data,
     get_adjectives_for_noun,
     get_verbs_for_noun,
+    pos_tag_captions,
+    load_occurrences_data,
 )
 
 # stanfordnlp.download('en', confirm_if_exists=True)
 
 base_dir = os.path.dirname(os.path.abspath(__file__))
 
+nlp_pipeline = None
+
+
+def get_nlp_pipeline():
+    """Load the stanfordnlp pipeline only once per process."""
+    global nlp_pipeline
+    if nlp_pipeline is None:
+        nlp_pipeline = stanfordnlp.Pipeline(
+            processors="tokenize,pos,lemma,depparse", tokenize_pretokenized=True
+        )
+    return nlp_pipeline
+
 
 def recall_pairs(generated_captions, word_map, heldout_pairs, output_file_name):
     logging.info("\n\nRecall@{}:".format(len(next(iter(generated_captions.values())))))
     recall_scores = {}
-    nlp_pipeline = stanfordnlp.Pipeline()
+    nlp_pipeline = get_nlp_pipeline()
     for pair in heldout_pairs:
         occurrences_data_file = os.path.join(
             base_dir, "data", "occurrences", pair + ".json"
         )
-        occurrences_data = json.load(open(occurrences_data_file, "r"))
+        occurrences_data = load_occurrences_data(occurrences_data_file)
 
         _, _, test_indices = get_splits_from_occurrences_data([pair])
         nouns = set(occurrences_data[NOUNS])
@@ -95,18 +120,22 @@ def calc_recall(
     numbers = dict.fromkeys(["N=1", "N=2", "N=3", "N=4", "N=5"], 0)
     adjective_frequencies = Counter()
     verb_frequencies = Counter()
+
+    # POS-tag the captions of all images in a single pass of the pipeline
+    decoded_captions = [
+        decode_caption(get_caption_without_special_tokens(caption, word_map), word_map)
+        for coco_id in test_indices
+        for caption in generated_captions[coco_id]
+    ]
+    pos_tagged_captions = iter(pos_tag_captions(nlp_pipeline, decoded_captions))
+
     for coco_id in test_indices:
         top_k_captions = generated_captions[coco_id]
         count = occurrences_data[OCCURRENCE_DATA][coco_id][PAIR_OCCURENCES]
 
         hit = False
-        for caption in top_k_captions:
-            caption = " ".join(
-                decode_caption(
-                    get_caption_without_special_tokens(caption, word_map), word_map
-                )
-            )
-            pos_tagged_caption = nlp_pipeline(caption).sentences[0]
+        for _ in top_k_captions:
+            pos_tagged_caption = next(pos_tagged_captions)
             _, _, contains_pair = contains_pair_function(
                 pos_tagged_caption, nouns, other
             )
@@ -164,17 +193,22 @@ def beam_occurrences(
         occurrences_data_file = os.path.join(
             base_dir, "data", "occurrences", pair + ".json"
         )
-        occurrences_data = json.load(open(occurrences_data_file, "r"))
+        occurrences_data = load_occurrences_data(occurrences_data_file)
 
         _, _, test_indices = get_splits_from_occurrences_data([pair])
 
         nouns = set(occurrences_data[NOUNS])
+        others = set()
         if ADJECTIVES in occurrences_data:
-            adjectives = set(occurrences_data[ADJECTIVES])
-        if VERBS in occurrences_data:
-            verbs = set(occurrences_data[VERBS])
+            others = set(occurrences_data[ADJECTIVES])
+        elif VERBS in occurrences_data:
+            others = set(occurrences_data[VERBS])
 
-        max_length = max([beams[-1].size(1) for beams in generated_beams.values()])
+        # Look for the word ids in the beam instead of decoding every branch
+        noun_ids = np.array([word_map[w] for w in nouns if w in word_map])
+        other_ids = np.array([word_map[w] for w in others if w in word_map])
+
+        max_length = max([len(beams[-1][0]) for beams in generated_beams.values()])
         noun_occurrences = np.zeros(max_length)
         other_occurrences = np.zeros(max_length)
         pair_occurrences = np.zeros(max_length)
@@ -184,26 +218,18 @@ def beam_occurrences(
         for coco_id in test_indices:
             beam = generated_beams[coco_id]
             for step, beam_timestep in enumerate(beam):
-                noun_match = False
-                other_match = False
-                pair_match = False
-                for branch in beam_timestep:
-                    branch_words = set(decode_caption(branch.numpy(), word_map))
-                    noun_occurs = bool(nouns & branch_words)
-
-                    if ADJECTIVES in occurrences_data:
-                        adjective_occurs = bool(adjectives & branch_words)
-                        if adjective_occurs:
-                            other_match = True
-                    elif VERBS in occurrences_data:
-                        verb_occurs = bool(verbs & branch_words)
-                        if verb_occurs:
-                            other_match = True
-                    if noun_occurs:
-                        noun_match = True
-
-                    if noun_occurs and other_match:
-                        pair_match = True
+                beam_timestep = np.array(beam_timestep)
+
+                # Occurrences for each branch of the beam
+                noun_occurs = np.isin(beam_timestep, noun_ids).any(axis=1)
+                other_occurs = np.isin(beam_timestep, other_ids).any(axis=1)
+
+                noun_match = noun_occurs.any()
+                other_match = other_occurs.any()
+                # A noun matches the pair if the adjective/verb occurred in the same or a preceding branch
+                pair_match = (
+                    noun_occurs & np.logical_or.accumulate(other_occurs)
+                ).any()
                 if noun_match:
                     noun_occurrences[step] += 1
                 if other_match:
@@ -243,3 +269,111 @@ def beam_occurrences(
         plt.xlabel("timestep")
         plt.title("Recall@{} for {} in the decoding beam".format(beam_size, name))
         plt.show()
+
+
+def bleu_statistics(list_of_references, hypotheses, max_n):
+    """
+    Calculate the statistics of a part of the corpus that the corpus BLEU score is
+    based on.
+
+    :param list_of_references: reference captions for every hypothesis
+    :param hypotheses: generated captions
+    :param max_n: highest n-gram order
+    :return: n-gram matches and n-gram counts for every order, length of the
+        hypotheses, length of the closest references
+    """
+    p_numerators = np.zeros(max_n, dtype=np.int64)
+    p_denominators = np.zeros(max_n, dtype=np.int64)
+    hyp_lengths, ref_lengths = 0, 0
+    for references, hypothesis in zip(list_of_references, hypotheses):
+        for i in range(max_n):
+            p_i = modified_precision(references, hypothesis, i + 1)
+            p_numerators[i] += p_i.numerator
+            p_denominators[i] += p_i.denominator
+
+        hyp_lengths += len(hypothesis)
+        ref_lengths += closest_ref_length(references, len(hypothesis))
+    return p_numerators, p_denominators, hyp_lengths, ref_lengths
+
+
+def create_process_pool(processes):
+    """
+    Create a pool of processes that are started by a fork server, so that they don't
+    inherit the CUDA context and the threads of the main process.
+
+    :param processes: number of processes
+    :return: process pool executor
+    """
+    return ProcessPoolExecutor(
+        processes, mp_context=multiprocessing.get_context("forkserver")
+    )
+
+
+def corpus_bleu_parallel(
+    list_of_references,
+    hypotheses,
+    weights=(0.25, 0.25, 0.25, 0.25),
+    processes=None,
+    executor=None,
+):
+    """
+    Calculate the corpus BLEU score in the same way as nltk's corpus_bleu without
+    smoothing, but collect the n-gram statistics of parts of the corpus in parallel
+    processes. The statistics are collected once for several weights.
+
+    :param list_of_references: reference captions for every hypothesis
+    :param hypotheses: generated captions
+    :param weights: weights for the n-gram orders, or a list of weights
+    :param processes: number of parts of the corpus, the number of CPUs by default
+    :param executor: process pool to collect the statistics in, a pool with the given
+        number of processes is created if None
+    :return: BLEU score, or a list of BLEU scores if a list of weights is given
+    """
+    list_of_references = list(list_of_references)
+    hypotheses = list(hypotheses)
+    assert len(list_of_references) == len(hypotheses)
+
+    multiple_weights = isinstance(weights[0], (tuple, list))
+    if not multiple_weights:
+        weights = [weights]
+    max_n = max(len(weight) for weight in weights)
+
+    # There are no matching n-grams in an empty corpus
+    if not hypotheses:
+        return [0] * len(weights) if multiple_weights else 0
+
+    processes = processes or os.cpu_count()
+    chunk_size = math.ceil(len(hypotheses) / processes)
+    chunks = range(0, len(hypotheses), chunk_size)
+    if executor is None:
+        executor = create_process_pool(processes)
+    else:
+        # The pool of the caller is not shut down after use
+        executor = contextlib.nullcontext(executor)
+    with executor as executor:
+        statistics = list(
+            executor.map(
+                bleu_statistics,
+                [list_of_references[i : i + chunk_size] for i in chunks],
+                [hypotheses[i : i + chunk_size] for i in chunks],
+                [max_n] * len(chunks),
+            )
+        )
+    p_numerators, p_denominators, hyp_lengths, ref_lengths = (
+        sum(values) for values in zip(*statistics)
+    )
+
+    # There are no matching n-grams of higher orders if there are no matching unigrams
+    if p_numerators[0] == 0:
+        return [0] * len(weights) if multiple_weights else 0
+
+    bp = brevity_penalty(ref_lengths, hyp_lengths)
+    p_n = SmoothingFunction().method0(
+        [Fraction(int(num), int(den)) for num, den in zip(p_numerators, p_denominators)]
+    )
+
+    bleu_scores = [
+        bp * math.exp(math.fsum(w_i * math.log(p_i) for w_i, p_i in zip(weight, p_n)))
+        for weight in weights
+    ]
+    return bleu_scores if multiple_weights else bleu_scores[0]
@@ -1,3 +1,5 @@
+import weakref
+
 import torch
 from torch import nn
 
@@ -5,6 +7,10 @@ from models.captioning_model import CaptioningModelDecoder
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+# Buffers for the inputs of the LSTM cells during inference, they are kept outside of
+# the modules so that they are not saved in checkpoints
+lstm_input_buffers = weakref.WeakKeyDictionary()
+
 
 class TopDownDecoder(CaptioningModelDecoder):
     DEFAULT_MODEL_PARAMS = {
@@ -71,18 +77,22 @@ class TopDownDecoder(CaptioningModelDecoder):
         c1 = self.init_c1(v_mean)
         h2 = self.init_h2(v_mean)
         c2 = self.init_c2(v_mean)
-        states = [h1, c1, h2, c2]
+
+        # The mean and the projection of the image features for the attention are the
+        # same for all timesteps, so they are computed once and passed along with the
+        # LSTM states
+        image_features_embedded = self.attention.embed_image_features(encoder_output)
+        states = [h1, c1, h2, c2, v_mean, image_features_embedded]
 
         return states
 
     def forward_step(self, encoder_output, prev_words_embedded, states):
-        v_mean = encoder_output.mean(dim=1)
-        h1, c1, h2, c2 = states
+        h1, c1, h2, c2, v_mean, image_features_embedded = states
         h1, c1 = self.attention_lstm(h1, c1, h2, v_mean, prev_words_embedded)
-        v_hat = self.attention(encoder_output, h1)
+        v_hat = self.attention(encoder_output, image_features_embedded, h1)
         h2, c2 = self.language_lstm(h2, c2, h1, v_hat)
         scores = self.fully_connected(self.dropout(h2))
-        states = [h1, c1, h2, c2]
+        states = [h1, c1, h2, c2, v_mean, image_features_embedded]
         return scores, states, None
 
     def loss(self, scores, target_captions, decode_lengths, alphas):
@@ -108,6 +118,35 @@ class TopDownDecoder(CaptioningModelDecoder):
         )
 
 
+def cat_lstm_inputs(module, inputs):
+    """
+    Concatenate the inputs of an LSTM cell. When no gradients are computed, the inputs
+    are written into a buffer of the module that is reused in every timestep. Compiled
+    code manages its own buffers.
+    """
+    if torch.is_grad_enabled() or torch.compiler.is_compiling():
+        return torch.cat(inputs, dim=1)
+
+    batch_size = inputs[0].size(0)
+    input_size = sum(input.size(1) for input in inputs)
+    buffer = lstm_input_buffers.get(module)
+    if (
+        buffer is None
+        or buffer.size(0) < batch_size
+        or buffer.size(1) != input_size
+        or buffer.dtype != inputs[0].dtype
+        or buffer.device != inputs[0].device
+        or (buffer.is_inference() and not torch.is_inference_mode_enabled())
+    ):
+        buffer = inputs[0].new_empty((batch_size, input_size))
+        lstm_input_buffers[module] = buffer
+
+    # The beam shrinks during beam search, so only the first rows may be used
+    buffer = buffer[:batch_size]
+    torch.cat(inputs, dim=1, out=buffer)
+    return buffer
+
+
 class AttentionLSTM(nn.Module):
     def __init__(self, dim_word_emb, dim_lang_lstm, dim_image_feats, hidden_size):
         super(AttentionLSTM, self).__init__()
@@ -116,7 +155,7 @@ class AttentionLSTM(nn.Module):
         )
 
     def forward(self, h1, c1, h2, v_mean, prev_words_embedded):
-        input_features = torch.cat((h2, v_mean, prev_words_embedded), dim=1)
+        input_features = cat_lstm_inputs(self, (h2, v_mean, prev_words_embedded))
         h_out, c_out = self.lstm_cell(input_features, (h1, c1))
         return h_out, c_out
 
@@ -129,7 +168,7 @@ class LanguageLSTM(nn.Module):
         )
 
     def forward(self, h2, c2, h1, v_hat):
-        input_features = torch.cat((h1, v_hat), dim=1)
+        input_features = cat_lstm_inputs(self, (h1, v_hat))
         h_out, c_out = self.lstm_cell(input_features, (h2, c2))
         return h_out, c_out
 
@@ -141,22 +180,24 @@ class VisualAttention(nn.Module):
             dim_image_features, hidden_layer_size, bias=False
         )
         self.linear_att_lstm = nn.Linear(dim_att_lstm, hidden_layer_size, bias=False)
-        self.tanh = nn.Tanh()
         self.linear_attention = nn.Linear(hidden_layer_size, 1)
-        self.softmax = nn.Softmax(dim=1)
-
-    def forward(self, image_features, h1):
-        image_features_embedded = self.linear_image_features(image_features)
-        att_lstm_embedded = self.linear_att_lstm(h1).unsqueeze(1)
 
-        all_feats_emb = image_features_embedded + att_lstm_embedded.repeat(
-            1, image_features.size()[1], 1
-        )
+    def embed_image_features(self, image_features):
+        return self.linear_image_features(image_features)
 
-        activate_feats = self.tanh(all_feats_emb)
-        attention = self.linear_attention(activate_feats)
-        normalized_attention = self.softmax(attention)
+    def forward(self, image_features, image_features_embedded, h1):
+        att_lstm_embedded = self.linear_att_lstm(h1).unsqueeze(1)
 
-        weighted_feats = normalized_attention * image_features
-        attention_weighted_image_features = weighted_feats.sum(dim=1)
+        # Broadcast the LSTM embedding over all image features, the activation is
+        # applied in-place to avoid another (batch_size, num_boxes, hidden_layer_size)
+        # tensor
+        activate_feats = torch.tanh_(image_features_embedded + att_lstm_embedded)
+        attention = self.linear_attention(activate_feats).squeeze(2)
+        normalized_attention = torch.softmax(attention, dim=1)
+
+        # Weighted sum of the image features: (batch_size, 1, num_boxes) x
+        # (batch_size, num_boxes, image_features_size)
+        attention_weighted_image_features = torch.bmm(
+            normalized_attention.unsqueeze(1), image_features
+        ).squeeze(1)
         return attention_weighted_image_features
@@ -1,9 +1,17 @@
 import torch
 from torch import nn
-from torch.autograd import Variable
 import torch.nn.functional as F
 
-from models.captioning_model import CaptioningModelDecoder, print_current_beam
+from models.bottom_up_top_down import cat_lstm_inputs
+from models.captioning_model import (
+    CaptioningModelDecoder,
+    print_current_beam,
+    sort_order_by_scores,
+    split_ended_sequences,
+    top_k_sharded,
+    update_decode_lengths,
+    END_CHECK_INTERVAL,
+)
 from utils import TOKEN_START, TOKEN_END
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -34,11 +42,11 @@ class ContrastiveLoss(nn.Module):
         # image retrieval
         cost_im = (self.margin + scores - d2).clamp(min=0)
 
-        # clear diagonals
-        mask = torch.eye(scores.size(0)) > 0.5
-        I = Variable(mask).to(device)
-        cost_s = cost_s.masked_fill_(I, 0)
-        cost_im = cost_im.masked_fill_(I, 0)
+        # clear diagonals, the mask is created directly on the device as a boolean
+        # tensor instead of comparing a float identity matrix on the CPU and copying it
+        mask = torch.eye(scores.size(0), dtype=torch.bool, device=device)
+        cost_s = cost_s.masked_fill_(mask, 0)
+        cost_im = cost_im.masked_fill_(mask, 0)
 
         # keep the maximum violating negative for each query
         if self.max_violation:
@@ -142,29 +150,50 @@ class BottomUpTopDownRankingDecoder(CaptioningModelDecoder):
 
         self.loss_ranking = ContrastiveLoss()
 
-    def init_hidden_states(self, v_mean_embedded):
+    def init_hidden_states(self, images_embedded, v_mean_embedded):
         h_lan_enc, c_lan_enc = self.language_encoding_lstm.init_state(
             v_mean_embedded.size(0)
         )
         h_lan_gen = self.init_h_lan_gen(v_mean_embedded)
         c_lan_gen = self.init_c_lan_gen(v_mean_embedded)
-        states = [h_lan_enc, c_lan_enc, h_lan_gen, c_lan_gen]
+
+        # The projection of the images for the attention is the same for all
+        # timesteps, so it is computed once and passed along with the LSTM states
+        images_embedded_attention = self.attention.embed_images(images_embedded)
+        states = [
+            h_lan_enc,
+            c_lan_enc,
+            h_lan_gen,
+            c_lan_gen,
+            images_embedded_attention,
+        ]
 
         return states
 
+    def init_inference(self, encoder_output):
+        images_embedded, v_mean_embedded = self.image_embedding(encoder_output)
+        states = self.init_hidden_states(images_embedded, v_mean_embedded)
+        return images_embedded, states
+
     def forward_step(self, images_embedded, prev_words_embedded, states):
-        h_lan_enc, c_lan_enc, h_lan_gen, c_lan_gen = states
+        h_lan_enc, c_lan_enc, h_lan_gen, c_lan_gen, images_embedded_attention = states
 
         h_lan_enc, c_lan_enc = self.language_encoding_lstm(
             h_lan_enc, c_lan_enc, prev_words_embedded
         )
 
-        v_hat = self.attention(images_embedded, h_lan_enc)
+        v_hat = self.attention(images_embedded, images_embedded_attention, h_lan_enc)
         h_lan_gen, c_lan_gen = self.language_generation_lstm(
             h_lan_gen, c_lan_gen, h_lan_enc, v_hat
         )
         scores = self.fully_connected(self.dropout(h_lan_gen))
-        states = [h_lan_enc, c_lan_enc, h_lan_gen, c_lan_gen]
+        states = [
+            h_lan_enc,
+            c_lan_enc,
+            h_lan_gen,
+            c_lan_gen,
+            images_embedded_attention,
+        ]
         return scores, states, None
 
     def forward_joint(self, encoder_output, target_captions=None, decode_lengths=None):
@@ -175,18 +204,23 @@ class BottomUpTopDownRankingDecoder(CaptioningModelDecoder):
         # Flatten image
         encoder_output = encoder_output.view(batch_size, -1, encoder_output.size(-1))
 
-        if not self.training:
+        if self.training and self.params["teacher_forcing_ratio"] == 1:
+            return self.forward_joint_teacher_forcing(
+                encoder_output, target_captions, decode_lengths
+            )
+
+        # The decode lengths are only known on the host if the captions are generated
+        if self.training:
+            max_decode_length = int(decode_lengths.max())
+        else:
+            max_decode_length = self.params["max_caption_len"]
             decode_lengths = torch.full(
-                (batch_size,),
-                self.params["max_caption_len"],
-                dtype=torch.int64,
-                device=device,
+                (batch_size,), max_decode_length, dtype=torch.int64, device=device
             )
 
-        # Tensors to hold word prediction scores
-        scores = torch.zeros(
-            (batch_size, max(decode_lengths), self.vocab_size), device=device
-        )
+        # List to hold word prediction scores of all timesteps, they are stacked after
+        # decoding
+        scores = []
         lang_enc_hidden_activations = None
         if self.training:
             # Tensor to store hidden activations of the language encoding LSTM of the last timestep, these will be the
@@ -196,37 +230,31 @@ class BottomUpTopDownRankingDecoder(CaptioningModelDecoder):
             )
 
         # At the start, all 'previous words' are the <start> token
-        prev_words = torch.full(
-            (batch_size,), self.word_map[TOKEN_START], dtype=torch.int64, device=device
-        )
+        prev_words_embedded = self.embed_start_token(batch_size)
 
         # Embed images
         images_embedded, v_mean_embedded = self.image_embedding(encoder_output)
 
         # Initialize LSTM states
-        states = self.init_hidden_states(v_mean_embedded)
-
-        for t in range(max(decode_lengths)):
-            if not self.training:
-                # Find all sequences where an <end> token has been produced in the last timestep
-                ind_end_token = (
-                    torch.nonzero(prev_words == self.word_map[TOKEN_END])
-                    .view(-1)
-                    .tolist()
+        states = self.init_hidden_states(images_embedded, v_mean_embedded)
+
+        for t in range(max_decode_length):
+            if t > 0 and not self.training:
+                # Update the decode lengths of all sequences where an <end> token has
+                # been produced in the last timestep (the mask stays on the device)
+                decode_lengths = update_decode_lengths(
+                    decode_lengths, prev_words == self.word_map[TOKEN_END], t
                 )
 
-                # Update the decode lengths accordingly
-                decode_lengths[ind_end_token] = torch.min(
-                    decode_lengths[ind_end_token],
-                    torch.full_like(decode_lengths[ind_end_token], t, device=device),
-                )
+                # Check if all sequences are finished, this requires a sync with
+                # the device, so it is done only every few timesteps
+                if t % END_CHECK_INTERVAL == 0 and not bool((decode_lengths > t).any()):
+                    break
 
-            # Check if all sequences are finished:
-            indices_incomplete_sequences = torch.nonzero(decode_lengths > t).view(-1)
-            if len(indices_incomplete_sequences) == 0:
-                break
+            incomplete_sequences = (decode_lengths > t).unsqueeze(1)
 
-            prev_words_embedded = self.word_embedding(prev_words)
+            if t > 0:
+                prev_words_embedded = self.word_embedding(prev_words)
             scores_for_timestep, states, alphas_for_timestep = self.forward_step(
                 images_embedded, prev_words_embedded, states
             )
@@ -236,14 +264,16 @@ class BottomUpTopDownRankingDecoder(CaptioningModelDecoder):
                 scores_for_timestep, target_captions, t
             )
 
-            scores[indices_incomplete_sequences, t, :] = scores_for_timestep[
-                indices_incomplete_sequences
-            ]
+            scores.append(scores_for_timestep.masked_fill(~incomplete_sequences, 0))
             if self.training:
                 h_lan_enc = states[0]
-                lang_enc_hidden_activations[decode_lengths == t + 1] = h_lan_enc[
-                    decode_lengths == t + 1
-                ]
+                lang_enc_hidden_activations = torch.where(
+                    (decode_lengths == t + 1).unsqueeze(1),
+                    h_lan_enc,
+                    lang_enc_hidden_activations,
+                )
+
+        scores = torch.stack(scores, dim=1)
 
         captions_embedded = None
         if self.training:
@@ -252,7 +282,72 @@ class BottomUpTopDownRankingDecoder(CaptioningModelDecoder):
 
         return scores, decode_lengths, v_mean_embedded, captions_embedded, None
 
-    def forward(self, encoder_output, target_captions=None, decode_lengths=None):
+    def forward_joint_teacher_forcing(
+        self, encoder_output, target_captions, decode_lengths
+    ):
+        """
+        Forward pass for both ranking and caption generation with full teacher forcing.
+
+        None of the LSTMs depends on the output of the language generation LSTM in
+        this case, so all timesteps are computed at once instead of step by step.
+        """
+        batch_size = encoder_output.size(0)
+        max_decode_length = int(decode_lengths.max())
+
+        # Embed images
+        images_embedded, v_mean_embedded = self.image_embedding(encoder_output)
+
+        # Initialize LSTM states
+        states = self.init_hidden_states(images_embedded, v_mean_embedded)
+        h_lan_enc, c_lan_enc, h_lan_gen, c_lan_gen, images_embedded_attention = states
+
+        # The input words are the target words, starting with <start>
+        prev_words_embedded = self.word_embedding(
+            target_captions[:, :max_decode_length]
+        )
+        h_lan_enc = lstm_cell_over_sequence(
+            self.language_encoding_lstm.lstm_cell,
+            prev_words_embedded,
+            h_lan_enc,
+            c_lan_enc,
+        )
+
+        v_hat = self.attention.forward_sequence(
+            images_embedded, images_embedded_attention, h_lan_enc
+        )
+        h_lan_gen = lstm_cell_over_sequence(
+            self.language_generation_lstm.lstm_cell,
+            torch.cat((h_lan_enc, v_hat), dim=2),
+            h_lan_gen,
+            c_lan_gen,
+        )
+
+        scores = self.fully_connected(self.dropout(h_lan_gen))
+
+        # Set the scores of timesteps after the end of a sequence to 0
+        incomplete_sequences = torch.arange(
+            max_decode_length, device=device
+        ) < decode_lengths.unsqueeze(1)
+        scores = scores.masked_fill(~incomplete_sequences.unsqueeze(2), 0)
+
+        # The caption embedding is based on the hidden activations of the language
+        # encoding LSTM of the last timestep
+        lang_enc_hidden_activations = h_lan_enc[
+            torch.arange(batch_size, device=device), decode_lengths - 1
+        ]
+        captions_embedded = self.caption_embedding(lang_enc_hidden_activations)
+        captions_embedded = l2_norm(captions_embedded)
+
+        return scores, decode_lengths, v_mean_embedded, captions_embedded, None
+
+    def forward(
+        self,
+        encoder_output,
+        target_captions=None,
+        decode_lengths=None,
+        store_alphas=True,
+    ):
+        # This model does not compute attention weights that could be stored
         scores, decode_lengths, v_mean_embedded, captions_embedded, alphas = self.forward_joint(
             encoder_output, target_captions, decode_lengths
         )
@@ -263,21 +358,21 @@ class BottomUpTopDownRankingDecoder(CaptioningModelDecoder):
         batch_size = captions.size(0)
         h_lan_enc, c_lan_enc = self.language_encoding_lstm.init_state(batch_size)
 
-        # Tensor to store hidden activations
-        lang_enc_hidden_activations = torch.zeros(
-            (batch_size, self.params["language_encoding_lstm_size"]), device=device
+        # Encode all timesteps at once
+        prev_words_embedded = self.word_embedding(
+            captions[:, : int(decode_lengths.max())]
+        )
+        h_lan_enc = lstm_cell_over_sequence(
+            self.language_encoding_lstm.lstm_cell,
+            prev_words_embedded,
+            h_lan_enc,
+            c_lan_enc,
         )
 
-        for t in range(max(decode_lengths)):
-            prev_words_embedded = self.word_embedding(captions[:, t])
-
-            h_lan_enc, c_lan_enc = self.language_encoding_lstm(
-                h_lan_enc, c_lan_enc, prev_words_embedded
-            )
-
-            lang_enc_hidden_activations[decode_lengths == t + 1] = h_lan_enc[
-                decode_lengths == t + 1
-            ]
+        # Use the hidden activations of the last timestep of each caption
+        lang_enc_hidden_activations = h_lan_enc[
+            torch.arange(batch_size, device=device), decode_lengths - 1
+        ]
 
         captions_embedded = self.caption_embedding(lang_enc_hidden_activations)
         captions_embedded = l2_norm(captions_embedded)
@@ -313,49 +408,39 @@ class BottomUpTopDownRankingDecoder(CaptioningModelDecoder):
 
         current_beam_width = beam_size
 
-        enc_image_size = encoder_output.size(1)
         encoder_dim = encoder_output.size()[-1]
 
         # Flatten encoding
         encoder_output = encoder_output.view(1, -1, encoder_dim)
 
+        # Embed the image and initialize the LSTM states only once, they are the same
+        # for all sequences at the start
+        images_embedded, states = self.init_inference(encoder_output)
+
         # We'll treat the problem as having a batch size of k
-        encoder_output = encoder_output.expand(
-            beam_size, encoder_output.size(1), encoder_dim
-        )
+        images_embedded = images_embedded.expand(beam_size, -1, -1)
+        states = [state.expand(beam_size, *state.size()[1:]) for state in states]
 
-        # Tensor to store top k sequences; now they're just <start>
-        top_k_sequences = torch.full(
-            (beam_size, 1), self.word_map[TOKEN_START], dtype=torch.int64, device=device
-        )
+        # Lists to store top k sequences; now they're just <start>. The sequences are
+        # only used for bookkeeping, so they are kept on the host
+        top_k_sequences = [[self.word_map[TOKEN_START]] for _ in range(beam_size)]
+
+        # Embeddings of the last words of the top k sequences; now they're just <start>
+        prev_word_embeddings = self.embed_start_token(beam_size)
 
         # Tensor to store top k sequences' scores; now they're just 0
         top_k_scores = torch.zeros(beam_size, device=device)
 
-        if store_alphas:
-            # Tensor to store top k sequences' alphas; now they're just 1s
-            seqs_alpha = torch.ones(beam_size, 1, enc_image_size, enc_image_size).to(
-                device
-            )
-
-        # Lists to store completed sequences, scores, and alphas and the full decoding beam
+        # Lists to store completed sequences and scores and the full decoding beam
         complete_seqs = []
-        complete_seqs_alpha = []
         complete_seqs_scores = []
         beam = []
 
-        # Embed images
-        images_embedded, v_mean_embedded = self.image_embedding(encoder_output)
-
-        # Initialize LSTM states
-        states = self.init_hidden_states(v_mean_embedded)
-
         # Start decoding
         for step in range(0, self.params["max_caption_len"] - 1):
-            prev_words = top_k_sequences[:, step]
-
-            prev_word_embeddings = self.word_embedding(prev_words)
-            predictions, states, alpha = self.forward_step(
+            if step > 0:
+                prev_word_embeddings = self.word_embedding(prev_words)
+            predictions, states, _ = self.forward_step(
                 images_embedded, prev_word_embeddings, states
             )
             scores = F.log_softmax(predictions, dim=1)
@@ -369,124 +454,108 @@ class BottomUpTopDownRankingDecoder(CaptioningModelDecoder):
                 scores = scores[0]
 
             # Find the top k of the flattened scores
-            top_k_scores, top_k_words = scores.view(-1).topk(
-                current_beam_width, 0, largest=True, sorted=True
-            )
+            top_k_scores, top_k_words = top_k_sharded(scores, current_beam_width)
 
             # Convert flattened indices to actual indices of scores
-            prev_seq_inds = top_k_words / self.vocab_size  # (k)
+            prev_seq_inds = torch.div(
+                top_k_words, self.vocab_size, rounding_mode="floor"
+            )  # (k)
             next_words = top_k_words % self.vocab_size  # (k)
 
             # Add new words to sequences
-            top_k_sequences = torch.cat(
-                (top_k_sequences[prev_seq_inds], next_words.unsqueeze(1)), dim=1
-            )
+            next_words_list = next_words.tolist()
+            top_k_sequences = [
+                top_k_sequences[prev_seq_ind] + [next_word]
+                for prev_seq_ind, next_word in zip(
+                    prev_seq_inds.tolist(), next_words_list
+                )
+            ]
 
             if print_beam:
                 print_current_beam(top_k_sequences, top_k_scores, self.word_map)
             if store_beam:
                 beam.append(top_k_sequences)
 
-            # Store the new alphas
-            if store_alphas:
-                alpha = alpha.view(-1, enc_image_size, enc_image_size)
-                seqs_alpha = torch.cat(
-                    (seqs_alpha[prev_seq_inds], alpha[prev_seq_inds].unsqueeze(1)),
-                    dim=1,
-                )
-
-            # Check for complete and incomplete sequences (based on the <end> token)
-            incomplete_inds = (
-                torch.nonzero(next_words != self.word_map[TOKEN_END]).view(-1).tolist()
-            )
-            complete_inds = (
-                torch.nonzero(next_words == self.word_map[TOKEN_END]).view(-1).tolist()
+            # Check for complete and incomplete sequences (based on the <end> token),
+            # the words are already on the host so the beam width is known without
+            # waiting for the device
+            complete_inds, incomplete_inds = split_ended_sequences(
+                next_words_list, self.word_map[TOKEN_END]
             )
 
             # Set aside complete sequences and reduce beam size accordingly
             if len(complete_inds) > 0:
-                complete_seqs.extend(top_k_sequences[complete_inds].tolist())
-                complete_seqs_scores.extend(top_k_scores[complete_inds])
-                if store_alphas:
-                    complete_seqs_alpha.extend(seqs_alpha[complete_inds].tolist())
+                complete_seqs.extend(
+                    sequence
+                    for sequence, next_word in zip(top_k_sequences, next_words_list)
+                    if next_word == self.word_map[TOKEN_END]
+                )
+                complete_seqs_scores.append(top_k_scores[complete_inds])
 
             # Stop if k captions have been completely generated
             current_beam_width = len(incomplete_inds)
             if current_beam_width == 0:
                 break
 
-            # Proceed with incomplete sequences
-            top_k_sequences = top_k_sequences[incomplete_inds]
-            for i in range(len(states)):
-                states[i] = states[i][prev_seq_inds[incomplete_inds]]
-            images_embedded = images_embedded[prev_seq_inds[incomplete_inds]]
-            v_mean_embedded = v_mean_embedded[prev_seq_inds[incomplete_inds]]
-            top_k_scores = top_k_scores[incomplete_inds]
-            if store_alphas:
-                seqs_alpha = seqs_alpha[incomplete_inds]
+            # Proceed with incomplete sequences, all states are gathered with the same
+            # index tensor
+            gather_inds = prev_seq_inds[incomplete_inds]
+            top_k_sequences = [
+                sequence
+                for sequence, next_word in zip(top_k_sequences, next_words_list)
+                if next_word != self.word_map[TOKEN_END]
+            ]
+            states = [state.index_select(0, gather_inds) for state in states]
+            images_embedded = images_embedded.index_select(0, gather_inds)
+            top_k_scores = top_k_scores.index_select(0, incomplete_inds)
+            prev_words = next_words.index_select(0, incomplete_inds)
 
         if len(complete_seqs) < beam_size:
-            complete_seqs.extend(top_k_sequences.tolist())
-            complete_seqs_scores.extend(top_k_scores)
-            if store_alphas:
-                complete_seqs_alpha.extend(seqs_alpha)
-
-        sorted_sequences = [
-            sequence
-            for _, sequence in sorted(
-                zip(complete_seqs_scores, complete_seqs), reverse=True
-            )
-        ]
-        sorted_alphas = None
-        if store_alphas:
-            sorted_alphas = [
-                alpha
-                for _, alpha in sorted(
-                    zip(complete_seqs_scores, complete_seqs_alpha), reverse=True
-                )
-            ]
-        return sorted_sequences, sorted_alphas, beam
+            complete_seqs.extend(top_k_sequences)
+            complete_seqs_scores.append(top_k_scores)
+
+        # Sort the sequences by their scores, with a single copy from the device
+        order = sort_order_by_scores(complete_seqs_scores)
+        sorted_sequences = [complete_seqs[i] for i in order]
+        return sorted_sequences, None, beam
 
     def nucleus_sampling(self, encoder_output, beam_size, top_p, print_beam=False):
         """Generate and return the top k sequences using nucleus sampling."""
 
         current_beam_width = beam_size
 
-        enc_image_size = encoder_output.size(1)
         encoder_dim = encoder_output.size()[-1]
 
         # Flatten encoding
         encoder_output = encoder_output.view(1, -1, encoder_dim)
 
+        # Embed the image and initialize the LSTM states only once, they are the same
+        # for all sequences at the start
+        images_embedded, states = self.init_inference(encoder_output)
+
         # We'll treat the problem as having a batch size of k
-        encoder_output = encoder_output.expand(
-            beam_size, encoder_output.size(1), encoder_dim
-        )
+        images_embedded = images_embedded.expand(beam_size, -1, -1)
+        states = [state.expand(beam_size, *state.size()[1:]) for state in states]
 
-        # Tensor to store top k sequences; now they're just <start>
-        top_k_sequences = torch.full(
-            (beam_size, 1), self.word_map[TOKEN_START], dtype=torch.int64, device=device
-        )
+        # Lists to store top k sequences; now they're just <start>. The sequences are
+        # only used for bookkeeping, so they are kept on the host
+        top_k_sequences = [[self.word_map[TOKEN_START]] for _ in range(beam_size)]
+
+        # Embeddings of the last words of the top k sequences; now they're just <start>
+        prev_word_embeddings = self.embed_start_token(beam_size)
 
         # Tensor to store top k sequences' scores; now they're just 0
         top_k_scores = torch.zeros(beam_size, device=device)
 
-        # Lists to store completed sequences, scores, and alphas and the full decoding beam
+        # Lists to store completed sequences and scores
         complete_seqs = []
         complete_seqs_scores = []
 
-        # Embed images
-        images_embedded, v_mean_embedded = self.image_embedding(encoder_output)
-
-        # Initialize LSTM states
-        states = self.init_hidden_states(v_mean_embedded)
-
         # Start decoding
         for step in range(0, self.params["max_caption_len"] - 1):
-            prev_words = top_k_sequences[:, step]
-
-            prev_word_embeddings = self.word_embedding(prev_words)
-            predictions, states, alpha = self.forward_step(
+            if step > 0:
+                prev_word_embeddings = self.word_embedding(prev_words)
+            predictions, states, _ = self.forward_step(
                 images_embedded, prev_word_embeddings, states
             )
             scores = F.log_softmax(predictions, dim=1)
@@ -502,42 +571,43 @@ class BottomUpTopDownRankingDecoder(CaptioningModelDecoder):
             ].clone()
             sorted_indices_to_remove[..., 0] = 0
 
-            top_k_scores = torch.zeros(
-                current_beam_width, dtype=torch.float, device=device
-            )
-            top_k_words = torch.zeros(
-                current_beam_width, dtype=torch.long, device=device
+            # Map the removed tokens back to the vocabulary order and mask them for all
+            # sequences at once
+            indices_to_remove = sorted_indices_to_remove.scatter(
+                1, sorted_indices, sorted_indices_to_remove
             )
+            scores = scores.masked_fill(indices_to_remove, -float("inf"))
 
-            for i in range(0, current_beam_width):
-                scores[i][sorted_indices[i][sorted_indices_to_remove[i]]] = -float(
-                    "inf"
-                )
-
-                # Sample from the scores
-                top_k_words[i] = torch.multinomial(torch.softmax(scores[i], -1), 1)
-                top_k_scores[i] = scores[i][top_k_words[i]]
+            # Sample from the scores
+            top_k_words = torch.multinomial(torch.softmax(scores, -1), 1)
+            top_k_scores = scores.gather(1, top_k_words).squeeze(1)
+            top_k_words = top_k_words.squeeze(1)
 
             # Add new words to sequences
-            top_k_sequences = torch.cat(
-                (top_k_sequences, top_k_words.unsqueeze(1)), dim=1
-            )
+            next_words_list = top_k_words.tolist()
+            top_k_sequences = [
+                sequence + [next_word]
+                for sequence, next_word in zip(top_k_sequences, next_words_list)
+            ]
 
             if print_beam:
                 print_current_beam(top_k_sequences, top_k_scores, self.word_map)
 
-            # Check for complete and incomplete sequences (based on the <end> token)
-            incomplete_inds = (
-                torch.nonzero(top_k_words != self.word_map[TOKEN_END]).view(-1).tolist()
-            )
-            complete_inds = (
-                torch.nonzero(top_k_words == self.word_map[TOKEN_END]).view(-1).tolist()
+            # Check for complete and incomplete sequences (based on the <end> token),
+            # the words are already on the host so the beam width is known without
+            # waiting for the device
+            complete_inds, incomplete_inds = split_ended_sequences(
+                next_words_list, self.word_map[TOKEN_END]
             )
 
             # Set aside complete sequences and reduce beam size accordingly
             if len(complete_inds) > 0:
-                complete_seqs.extend(top_k_sequences[complete_inds].tolist())
-                complete_seqs_scores.extend(top_k_scores[complete_inds])
+                complete_seqs.extend(
+                    sequence
+                    for sequence, next_word in zip(top_k_sequences, next_words_list)
+                    if next_word == self.word_map[TOKEN_END]
+                )
+                complete_seqs_scores.append(top_k_scores[complete_inds])
 
             # Stop if k captions have been completely generated
             current_beam_width = len(incomplete_inds)
@@ -545,23 +615,22 @@ class BottomUpTopDownRankingDecoder(CaptioningModelDecoder):
                 break
 
             # Proceed with incomplete sequences
-            top_k_sequences = top_k_sequences[incomplete_inds]
-            for i in range(len(states)):
-                states[i] = states[i][incomplete_inds]
-            images_embedded = images_embedded[incomplete_inds]
-            v_mean_embedded = v_mean_embedded[incomplete_inds]
-            top_k_scores = top_k_scores[incomplete_inds]
+            top_k_sequences = [
+                sequence
+                for sequence, next_word in zip(top_k_sequences, next_words_list)
+                if next_word != self.word_map[TOKEN_END]
+            ]
+            states = [state.index_select(0, incomplete_inds) for state in states]
+            images_embedded = images_embedded.index_select(0, incomplete_inds)
+            top_k_scores = top_k_scores.index_select(0, incomplete_inds)
+            prev_words = top_k_words.index_select(0, incomplete_inds)
 
         if len(complete_seqs) < beam_size:
-            complete_seqs.extend(top_k_sequences.tolist())
-            complete_seqs_scores.extend(top_k_scores)
+            complete_seqs.extend(top_k_sequences)
+            complete_seqs_scores.append(top_k_scores)
 
-        sorted_sequences = [
-            sequence
-            for _, sequence in sorted(
-                zip(complete_seqs_scores, complete_seqs), reverse=True
-            )
-        ]
+        order = sort_order_by_scores(complete_seqs_scores)
+        sorted_sequences = [complete_seqs[i] for i in order]
         return sorted_sequences, None, None
 
 
@@ -597,7 +666,7 @@ class LanguageGenerationLSTM(nn.Module):
         )
 
     def forward(self, h2, c2, h_lang_enc, v_hat):
-        input_features = torch.cat((h_lang_enc, v_hat), dim=1)
+        input_features = cat_lstm_inputs(self, (h_lang_enc, v_hat))
         h_out, c_out = self.lstm_cell(input_features, (h2, c2))
         return h_out, c_out
 
@@ -611,25 +680,47 @@ class VisualAttention(nn.Module):
         self.linear_lang_enc = nn.Linear(
             lang_enc_lstm_size, attention_layer_size, bias=False
         )
-        self.tanh = nn.Tanh()
         self.linear_attention = nn.Linear(attention_layer_size, 1)
-        self.softmax = nn.Softmax(dim=1)
 
-    def forward(self, images_embedded, h_lang_enc):
-        image_features_embedded = self.linear_image_features(images_embedded)
+    def embed_images(self, images_embedded):
+        return self.linear_image_features(images_embedded)
+
+    def forward(self, images_embedded, images_embedded_attention, h_lang_enc):
         h_lang_enc_embedded = self.linear_lang_enc(h_lang_enc).unsqueeze(1)
 
-        all_feats_emb = image_features_embedded + h_lang_enc_embedded.repeat(
-            1, images_embedded.size(1), 1
-        )
+        # Broadcast the LSTM embedding over all image boxes, the activation is applied
+        # in-place to avoid another (batch_size, num_boxes, attention_layer_size) tensor
+        activate_feats = torch.tanh_(images_embedded_attention + h_lang_enc_embedded)
+        attention = self.linear_attention(activate_feats).squeeze(2)
+        normalized_attention = torch.softmax(attention, dim=1)
+
+        # Weighted sum of the image boxes: (batch_size, 1, num_boxes) x
+        # (batch_size, num_boxes, joint_embeddings_size)
+        attention_weighted_image_features = torch.bmm(
+            normalized_attention.unsqueeze(1), images_embedded
+        ).squeeze(1)
+        return attention_weighted_image_features
 
-        activate_feats = self.tanh(all_feats_emb)
-        attention = self.linear_attention(activate_feats)
-        normalized_attention = self.softmax(attention)
+    def forward_sequence(self, images_embedded, images_embedded_attention, h_lang_enc):
+        """
+        Attend to the images for all timesteps at once.
 
-        weighted_feats = normalized_attention * images_embedded
-        attention_weighted_image_features = weighted_feats.sum(dim=1)
-        return attention_weighted_image_features
+        :param images_embedded: embedded image boxes, shape: (batch_size, num_boxes, joint_embeddings_size)
+        :param images_embedded_attention: image boxes projected by embed_images
+        :param h_lang_enc: hidden activations, shape: (batch_size, seq_len, lang_enc_lstm_size)
+        :return: attention weighted image features, shape: (batch_size, seq_len, joint_embeddings_size)
+        """
+        # (batch_size, 1, num_boxes, attention_layer_size)
+        image_features_embedded = images_embedded_attention.unsqueeze(1)
+
+        # (batch_size, seq_len, 1, attention_layer_size)
+        h_lang_enc_embedded = self.linear_lang_enc(h_lang_enc).unsqueeze(2)
+
+        activate_feats = torch.tanh_(image_features_embedded + h_lang_enc_embedded)
+        attention = self.linear_attention(activate_feats).squeeze(3)
+        normalized_attention = torch.softmax(attention, dim=2)
+
+        return torch.bmm(normalized_attention, images_embedded)
 
 
 class ImageEmbedding(nn.Module):
@@ -659,3 +750,33 @@ class ImageEmbedding(nn.Module):
         """
         for p in list(self.parameters()):
             p.requires_grad = enable_fine_tuning
+
+
+def lstm_cell_over_sequence(lstm_cell, inputs, h, c):
+    """
+    Apply an LSTM cell to all timesteps of a sequence in a single (cuDNN) LSTM call.
+
+    :param lstm_cell: the nn.LSTMCell, its weights are used as is
+    :param inputs: input sequence, shape: (batch_size, seq_len, input_size)
+    :param h: initial hidden state, shape: (batch_size, hidden_size)
+    :param c: initial cell state, shape: (batch_size, hidden_size)
+    :return: hidden states of all timesteps, shape: (batch_size, seq_len, hidden_size)
+    """
+    weights = [
+        lstm_cell.weight_ih,
+        lstm_cell.weight_hh,
+        lstm_cell.bias_ih,
+        lstm_cell.bias_hh,
+    ]
+    outputs, _, _ = torch.lstm(
+        inputs.contiguous(),
+        (h.unsqueeze(0), c.unsqueeze(0)),
+        weights,
+        True,  # has_biases
+        1,  # num_layers
+        0.0,  # dropout
+        lstm_cell.training,
+        False,  # bidirectional
+        True,  # batch_first
+    )
+    return outputs
@@ -3,12 +3,17 @@ import random
 import torch
 from torch import nn
 import torch.nn.functional as F
-from torch.nn.utils.rnn import pack_padded_sequence
 
 from utils import TOKEN_START, decode_caption, TOKEN_END
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+# Number of timesteps after which is checked whether all sequences are finished
+END_CHECK_INTERVAL = 8
+
+# Number of shards of the vocabulary for the top k search in beam search
+NUM_VOCABULARY_SHARDS = 128
+
 
 class CaptioningModelDecoder(nn.Module):
     DEFAULT_MODEL_PARAMS = {}
@@ -30,6 +35,22 @@ class CaptioningModelDecoder(nn.Module):
 
         self.loss_function = nn.CrossEntropyLoss().to(device)
 
+    def __getstate__(self):
+        # A compiled forward step can not be pickled, the checkpoint contains the
+        # original method
+        state = super(CaptioningModelDecoder, self).__getstate__()
+        state.pop("forward_step", None)
+        return state
+
+    def compile_forward_step(self, **kwargs):
+        """
+        Compile the forward step with torch.compile, so that the operations of a
+        timestep are fused into fewer kernels.
+
+        :param kwargs: arguments passed to torch.compile
+        """
+        self.forward_step = torch.compile(self.forward_step, **kwargs)
+
     def set_fine_tune_embeddings(self, fine_tune=True):
         """
         Allow fine-tuning of the embedding layer.
@@ -39,6 +60,17 @@ class CaptioningModelDecoder(nn.Module):
         for p in self.word_embedding.parameters():
             p.requires_grad = fine_tune
 
+    def embed_start_token(self, batch_size):
+        """
+        Embed the <start> token for all sequences of a batch. The row of the embedding
+        table is expanded without a lookup, so no index tensor needs to be created.
+
+        :param batch_size: number of sequences
+        :return: embeddings, shape: (batch_size, word_embeddings_size)
+        """
+        start_token_embedding = self.word_embedding.weight[self.word_map[TOKEN_START]]
+        return start_token_embedding.expand(batch_size, -1)
+
     def update_previous_word(self, scores, target_words, t):
         if self.training:
             if random.random() < self.params["teacher_forcing_ratio"]:
@@ -55,14 +87,21 @@ class CaptioningModelDecoder(nn.Module):
 
         return next_words
 
-    def forward(self, encoder_output, target_captions=None, decode_lengths=None):
+    def forward(
+        self,
+        encoder_output,
+        target_captions=None,
+        decode_lengths=None,
+        store_alphas=True,
+    ):
         """
         Forward propagation.
 
         :param encoder_output: output features of the encoder
         :param target_captions: encoded target captions, shape: (batch_size, max_caption_length)
-        :param decode_lengths: caption lengths, shape: (batch_size, 1)
-        :return: scores for vocabulary, decode lengths, weights
+        :param decode_lengths: caption lengths, shape: (batch_size)
+        :param store_alphas: Set to False if the attention weights are not needed
+        :return: scores for vocabulary, decode lengths, weights (None if not stored)
         """
 
         batch_size = encoder_output.size(0)
@@ -70,51 +109,43 @@ class CaptioningModelDecoder(nn.Module):
         # Flatten image
         encoder_output = encoder_output.view(batch_size, -1, encoder_output.size(-1))
 
-        if not self.training:
+        # The decode lengths are only known on the host if the captions are generated
+        if self.training:
+            max_decode_length = int(decode_lengths.max())
+        else:
+            max_decode_length = self.params["max_caption_len"]
             decode_lengths = torch.full(
-                (batch_size,),
-                self.params["max_caption_len"],
-                dtype=torch.int64,
-                device=device,
+                (batch_size,), max_decode_length, dtype=torch.int64, device=device
             )
 
         # Initialize LSTM state
         states = self.init_hidden_states(encoder_output)
 
-        # Tensors to hold word prediction scores and alphas
-        scores = torch.zeros(
-            (batch_size, max(decode_lengths), self.vocab_size), device=device
-        )
-        alphas = torch.zeros(
-            batch_size, max(decode_lengths), encoder_output.size(1), device=device
-        )
+        # Lists to hold word prediction scores and alphas of all timesteps, they are
+        # stacked after decoding
+        scores = []
+        alphas = []
 
         # At the start, all 'previous words' are the <start> token
-        prev_words = torch.full(
-            (batch_size,), self.word_map[TOKEN_START], dtype=torch.int64, device=device
-        )
-
-        for t in range(max(decode_lengths)):
-            if not self.training:
-                # Find all sequences where an <end> token has been produced in the last timestep
-                ind_end_token = (
-                    torch.nonzero(prev_words == self.word_map[TOKEN_END])
-                    .view(-1)
-                    .tolist()
+        prev_words_embedded = self.embed_start_token(batch_size)
+
+        for t in range(max_decode_length):
+            if t > 0 and not self.training:
+                # Update the decode lengths of all sequences where an <end> token has
+                # been produced in the last timestep (the mask stays on the device)
+                decode_lengths = update_decode_lengths(
+                    decode_lengths, prev_words == self.word_map[TOKEN_END], t
                 )
 
-                # Update the decode lengths accordingly
-                decode_lengths[ind_end_token] = torch.min(
-                    decode_lengths[ind_end_token],
-                    torch.full_like(decode_lengths[ind_end_token], t, device=device),
-                )
+                # Check if all sequences are finished, this requires a sync with
+                # the device, so it is done only every few timesteps
+                if t % END_CHECK_INTERVAL == 0 and not bool((decode_lengths > t).any()):
+                    break
 
-            # Check if all sequences are finished:
-            indices_incomplete_sequences = torch.nonzero(decode_lengths > t).view(-1)
-            if len(indices_incomplete_sequences) == 0:
-                break
+            incomplete_sequences = (decode_lengths > t).unsqueeze(1)
 
-            prev_words_embedded = self.word_embedding(prev_words)
+            if t > 0:
+                prev_words_embedded = self.word_embedding(prev_words)
             scores_for_timestep, states, alphas_for_timestep = self.forward_step(
                 encoder_output, prev_words_embedded, states
             )
@@ -124,32 +155,33 @@ class CaptioningModelDecoder(nn.Module):
                 scores_for_timestep, target_captions, t
             )
 
-            scores[indices_incomplete_sequences, t, :] = scores_for_timestep[
-                indices_incomplete_sequences
-            ]
-            if alphas_for_timestep is not None:
-                alphas[indices_incomplete_sequences, t, :] = alphas_for_timestep[
-                    indices_incomplete_sequences
-                ]
+            scores.append(scores_for_timestep.masked_fill(~incomplete_sequences, 0))
+            if store_alphas and alphas_for_timestep is not None:
+                alphas.append(alphas_for_timestep.masked_fill(~incomplete_sequences, 0))
+
+        scores = torch.stack(scores, dim=1)
+        if alphas:
+            alphas = torch.stack(alphas, dim=1)
+        else:
+            alphas = None
 
         return scores, decode_lengths, alphas
 
     def loss_cross_entropy(self, scores, target_captions, decode_lengths):
         # Since we decoded starting with <start>, the targets are all words after <start>, up to <end>
-        target_captions = target_captions[:, 1:]
-
-        # Remove timesteps that we didn't decode at, or are pads
-        decode_lengths, sort_ind = decode_lengths.sort(dim=0, descending=True)
-        packed_sequence = pack_padded_sequence(
-            scores[sort_ind], decode_lengths, batch_first=True
+        target_captions = target_captions[:, 1 : scores.size(1) + 1]
+
+        # Ignore timesteps that we didn't decode at, or are pads. This gives the same
+        # loss as packing the scores, but the scores don't need to be sorted and copied
+        timesteps = torch.arange(scores.size(1), device=device)
+        padding = timesteps.unsqueeze(0) >= decode_lengths.unsqueeze(1)
+        target_captions = target_captions.masked_fill(
+            padding, self.loss_function.ignore_index
         )
-        packed_scores = packed_sequence[0]
-        packed_target_sequence = pack_padded_sequence(
-            target_captions[sort_ind], decode_lengths, batch_first=True
-        )
-        packed_targets = packed_target_sequence[0]
 
-        return self.loss_function(packed_scores, packed_targets)
+        return self.loss_function(
+            scores.reshape(-1, self.vocab_size), target_captions.reshape(-1)
+        )
 
     def beam_search(
         self,
@@ -169,23 +201,30 @@ class CaptioningModelDecoder(nn.Module):
         # Flatten encoding
         encoder_output = encoder_output.view(1, -1, encoder_dim)
 
+        # Initialize hidden states only once, they are the same for all sequences at
+        # the start
+        encoder_output, states = self.init_inference(encoder_output)
+
         # We'll treat the problem as having a batch size of k
         encoder_output = encoder_output.expand(
             beam_size, encoder_output.size(1), encoder_dim
         )
+        states = [state.expand(beam_size, *state.size()[1:]) for state in states]
 
-        # Tensor to store top k sequences; now they're just <start>
-        top_k_sequences = torch.full(
-            (beam_size, 1), self.word_map[TOKEN_START], dtype=torch.int64, device=device
-        )
+        # Lists to store top k sequences; now they're just <start>. The sequences are
+        # only used for bookkeeping, so they are kept on the host
+        top_k_sequences = [[self.word_map[TOKEN_START]] for _ in range(beam_size)]
+
+        # Embeddings of the last words of the top k sequences; now they're just <start>
+        prev_word_embeddings = self.embed_start_token(beam_size)
 
         # Tensor to store top k sequences' scores; now they're just 0
         top_k_scores = torch.zeros(beam_size, device=device)
 
         if store_alphas:
             # Tensor to store top k sequences' alphas; now they're just 1s
-            seqs_alpha = torch.ones(beam_size, 1, enc_image_size, enc_image_size).to(
-                device
+            seqs_alpha = torch.ones(
+                beam_size, 1, enc_image_size, enc_image_size, device=device
             )
 
         # Lists to store completed sequences, scores, and alphas and the full decoding beam
@@ -194,14 +233,10 @@ class CaptioningModelDecoder(nn.Module):
         complete_seqs_scores = []
         beam = []
 
-        # Initialize hidden states
-        states = self.init_hidden_states(encoder_output)
-
         # Start decoding
         for step in range(0, self.params["max_caption_len"] - 1):
-            prev_words = top_k_sequences[:, step]
-
-            prev_word_embeddings = self.word_embedding(prev_words)
+            if step > 0:
+                prev_word_embeddings = self.word_embedding(prev_words)
             predictions, states, alpha = self.forward_step(
                 encoder_output, prev_word_embeddings, states
             )
@@ -216,18 +251,22 @@ class CaptioningModelDecoder(nn.Module):
                 scores = scores[0]
 
             # Find the top k of the flattened scores
-            top_k_scores, top_k_words = scores.view(-1).topk(
-                current_beam_width, 0, largest=True, sorted=True
-            )
+            top_k_scores, top_k_words = top_k_sharded(scores, current_beam_width)
 
             # Convert flattened indices to actual indices of scores
-            prev_seq_inds = top_k_words / self.vocab_size  # (k)
+            prev_seq_inds = torch.div(
+                top_k_words, self.vocab_size, rounding_mode="floor"
+            )  # (k)
             next_words = top_k_words % self.vocab_size  # (k)
 
             # Add new words to sequences
-            top_k_sequences = torch.cat(
-                (top_k_sequences[prev_seq_inds], next_words.unsqueeze(1)), dim=1
-            )
+            next_words_list = next_words.tolist()
+            top_k_sequences = [
+                top_k_sequences[prev_seq_ind] + [next_word]
+                for prev_seq_ind, next_word in zip(
+                    prev_seq_inds.tolist(), next_words_list
+                )
+            ]
 
             if print_beam:
                 print_current_beam(top_k_sequences, top_k_scores, self.word_map)
@@ -242,18 +281,21 @@ class CaptioningModelDecoder(nn.Module):
                     dim=1,
                 )
 
-            # Check for complete and incomplete sequences (based on the <end> token)
-            incomplete_inds = (
-                torch.nonzero(next_words != self.word_map[TOKEN_END]).view(-1).tolist()
-            )
-            complete_inds = (
-                torch.nonzero(next_words == self.word_map[TOKEN_END]).view(-1).tolist()
+            # Check for complete and incomplete sequences (based on the <end> token),
+            # the words are already on the host so the beam width is known without
+            # waiting for the device
+            complete_inds, incomplete_inds = split_ended_sequences(
+                next_words_list, self.word_map[TOKEN_END]
             )
 
             # Set aside complete sequences and reduce beam size accordingly
             if len(complete_inds) > 0:
-                complete_seqs.extend(top_k_sequences[complete_inds].tolist())
-                complete_seqs_scores.extend(top_k_scores[complete_inds])
+                complete_seqs.extend(
+                    sequence
+                    for sequence, next_word in zip(top_k_sequences, next_words_list)
+                    if next_word == self.word_map[TOKEN_END]
+                )
+                complete_seqs_scores.append(top_k_scores[complete_inds])
                 if store_alphas:
                     complete_seqs_alpha.extend(seqs_alpha[complete_inds].tolist())
 
@@ -262,37 +304,179 @@ class CaptioningModelDecoder(nn.Module):
             if current_beam_width == 0:
                 break
 
-            # Proceed with incomplete sequences
-            top_k_sequences = top_k_sequences[incomplete_inds]
-            for i in range(len(states)):
-                states[i] = states[i][prev_seq_inds[incomplete_inds]]
-            encoder_output = encoder_output[prev_seq_inds[incomplete_inds]]
-            top_k_scores = top_k_scores[incomplete_inds]
+            # Proceed with incomplete sequences, all states are gathered with the same
+            # index tensor
+            gather_inds = prev_seq_inds[incomplete_inds]
+            top_k_sequences = [
+                sequence
+                for sequence, next_word in zip(top_k_sequences, next_words_list)
+                if next_word != self.word_map[TOKEN_END]
+            ]
+            states = [state.index_select(0, gather_inds) for state in states]
+            encoder_output = encoder_output.index_select(0, gather_inds)
+            top_k_scores = top_k_scores.index_select(0, incomplete_inds)
+            prev_words = next_words.index_select(0, incomplete_inds)
             if store_alphas:
-                seqs_alpha = seqs_alpha[incomplete_inds]
+                seqs_alpha = seqs_alpha.index_select(0, incomplete_inds)
 
         if len(complete_seqs) < beam_size:
-            complete_seqs.extend(top_k_sequences.tolist())
-            complete_seqs_scores.extend(top_k_scores)
+            complete_seqs.extend(top_k_sequences)
+            complete_seqs_scores.append(top_k_scores)
             if store_alphas:
                 complete_seqs_alpha.extend(seqs_alpha)
 
-        sorted_sequences = [
-            sequence
-            for _, sequence in sorted(
-                zip(complete_seqs_scores, complete_seqs), reverse=True
-            )
-        ]
+        # Sort the sequences by their scores, with a single copy from the device
+        order = sort_order_by_scores(complete_seqs_scores)
+        sorted_sequences = [complete_seqs[i] for i in order]
         sorted_alphas = None
         if store_alphas:
-            sorted_alphas = [
-                alpha
-                for _, alpha in sorted(
-                    zip(complete_seqs_scores, complete_seqs_alpha), reverse=True
-                )
-            ]
+            sorted_alphas = [complete_seqs_alpha[i] for i in order]
         return sorted_sequences, sorted_alphas, beam
 
+    def init_inference(self, encoder_output):
+        """
+        Prepare the decoding of the flattened encoder output.
+
+        :return: inputs for the forward step, initial states
+        """
+        return encoder_output, self.init_hidden_states(encoder_output)
+
+    def batched_beam_search(self, encoder_output, beam_size):
+        """
+        Generate the top k sequences for a batch of images using beam search. Every
+        image has beam_size slots in the batch and the top k words are searched for
+        each image separately, so the beams of all images are decoded together.
+
+        :param encoder_output: output features of the encoder for a batch of images
+        :param beam_size: size of the beam
+        :return: list with the sequences sorted by score for every image
+        """
+        batch_size = encoder_output.size(0)
+
+        # Flatten encoding
+        encoder_output = encoder_output.view(batch_size, -1, encoder_output.size(-1))
+
+        step_inputs, states = self.init_inference(encoder_output)
+
+        # The slots of an image are next to each other in the batch. Beams only move
+        # between slots of the same image, so the inputs of a slot never change.
+        image_inds = torch.arange(batch_size, device=device).repeat_interleave(
+            beam_size
+        )
+        step_inputs = step_inputs.index_select(0, image_inds)
+        states = [state.index_select(0, image_inds) for state in states]
+
+        # Lists to store top k sequences and their scores for every image; now they're
+        # just a single <start> sequence. They are only used for bookkeeping, so they
+        # are kept on the host
+        top_k_sequences = [[[self.word_map[TOKEN_START]]] for _ in range(batch_size)]
+        top_k_sequences_scores = [[0.0] for _ in range(batch_size)]
+
+        # Number of incomplete sequences of every image
+        beam_widths = [beam_size] * batch_size
+
+        # Tensor to store the scores of all slots. Only the first slot of each image is
+        # used at the start, so that the first words are all taken from one sequence.
+        top_k_scores = torch.full((batch_size, beam_size), -float("inf"), device=device)
+        top_k_scores[:, 0] = 0
+        top_k_scores = top_k_scores.view(-1)
+
+        # Embeddings of the last words of all slots; now they're just <start>
+        prev_word_embeddings = self.embed_start_token(batch_size * beam_size)
+
+        # Lists to store completed sequences and scores for every image
+        complete_seqs = [[] for _ in range(batch_size)]
+        complete_seqs_scores = [[] for _ in range(batch_size)]
+
+        # Start decoding
+        for step in range(0, self.params["max_caption_len"] - 1):
+            if step > 0:
+                prev_word_embeddings = self.word_embedding(prev_words)
+            predictions, states, _ = self.forward_step(
+                step_inputs, prev_word_embeddings, states
+            )
+            scores = F.log_softmax(predictions, dim=1)
+
+            # Add the new scores
+            scores = top_k_scores.unsqueeze(1) + scores
+
+            # Find the top k of the flattened scores of all slots of each image
+            image_top_k_scores, top_k_words = scores.view(batch_size, -1).topk(
+                beam_size, dim=1
+            )
+
+            # Convert flattened indices to slots and words
+            prev_slots = torch.div(top_k_words, self.vocab_size, rounding_mode="floor")
+            next_words = top_k_words % self.vocab_size
+
+            # Update the sequences on the host. Only the first candidates of each image
+            # are used, as the beam shrinks whenever a sequence is completed.
+            prev_slots_list = prev_slots.tolist()
+            next_words_list = next_words.tolist()
+            scores_list = image_top_k_scores.tolist()
+            gather_inds = []
+            candidate_inds = []
+            empty_slots = []
+            for i in range(batch_size):
+                sequences = []
+                sequences_scores = []
+                for rank in range(beam_widths[i]):
+                    prev_slot = prev_slots_list[i][rank]
+                    next_word = next_words_list[i][rank]
+                    sequence = top_k_sequences[i][prev_slot] + [next_word]
+                    if next_word == self.word_map[TOKEN_END]:
+                        complete_seqs[i].append(sequence)
+                        complete_seqs_scores[i].append(scores_list[i][rank])
+                    else:
+                        sequences.append(sequence)
+                        sequences_scores.append(scores_list[i][rank])
+                        gather_inds.append(i * beam_size + prev_slot)
+                        candidate_inds.append(i * beam_size + rank)
+                        empty_slots.append(False)
+
+                # The remaining slots of the image are filled with the first slot and
+                # their scores are set to -inf
+                num_empty_slots = beam_size - len(sequences)
+                gather_inds.extend([i * beam_size] * num_empty_slots)
+                candidate_inds.extend([i * beam_size] * num_empty_slots)
+                empty_slots.extend([True] * num_empty_slots)
+
+                top_k_sequences[i] = sequences
+                top_k_sequences_scores[i] = sequences_scores
+                beam_widths[i] = len(sequences)
+
+            # Stop if k captions have been completely generated for all images
+            if sum(beam_widths) == 0:
+                break
+
+            # Proceed with incomplete sequences, the indices are copied to the device
+            # at once
+            inds = torch.tensor(
+                [gather_inds, candidate_inds, empty_slots], device=device
+            )
+            states = [state.index_select(0, inds[0]) for state in states]
+            top_k_scores = (
+                image_top_k_scores.view(-1)
+                .index_select(0, inds[1])
+                .masked_fill(inds[2].bool(), -float("inf"))
+            )
+            prev_words = next_words.view(-1).index_select(0, inds[1])
+
+        sorted_sequences = []
+        for i in range(batch_size):
+            if len(complete_seqs[i]) < beam_size:
+                complete_seqs[i].extend(top_k_sequences[i])
+                complete_seqs_scores[i].extend(top_k_sequences_scores[i])
+
+            order = sorted(
+                range(len(complete_seqs[i])),
+                key=lambda j: complete_seqs_scores[i][j],
+                reverse=True,
+            )
+            sorted_sequences.append([complete_seqs[i][j] for j in order])
+
+        return sorted_sequences
+
     def nucleus_sampling(self, encoder_output, beam_size, top_p, print_beam=False):
         """Generate and return the top k sequences using nucleus sampling."""
 
@@ -303,15 +487,22 @@ class CaptioningModelDecoder(nn.Module):
         # Flatten encoding
         encoder_output = encoder_output.view(1, -1, encoder_dim)
 
+        # Initialize hidden states only once, they are the same for all sequences at
+        # the start
+        encoder_output, states = self.init_inference(encoder_output)
+
         # We'll treat the problem as having a batch size of k
         encoder_output = encoder_output.expand(
             beam_size, encoder_output.size(1), encoder_dim
         )
+        states = [state.expand(beam_size, *state.size()[1:]) for state in states]
 
-        # Tensor to store top k sequences; now they're just <start>
-        top_k_sequences = torch.full(
-            (beam_size, 1), self.word_map[TOKEN_START], dtype=torch.int64, device=device
-        )
+        # Lists to store top k sequences; now they're just <start>. The sequences are
+        # only used for bookkeeping, so they are kept on the host
+        top_k_sequences = [[self.word_map[TOKEN_START]] for _ in range(beam_size)]
+
+        # Embeddings of the last words of the top k sequences; now they're just <start>
+        prev_word_embeddings = self.embed_start_token(beam_size)
 
         # Tensor to store top k sequences' scores; now they're just 0
         top_k_scores = torch.zeros(beam_size, device=device)
@@ -320,14 +511,10 @@ class CaptioningModelDecoder(nn.Module):
         complete_seqs = []
         complete_seqs_scores = []
 
-        # Initialize hidden states
-        states = self.init_hidden_states(encoder_output)
-
         # Start decoding
         for step in range(0, self.params["max_caption_len"] - 1):
-            prev_words = top_k_sequences[:, step]
-
-            prev_word_embeddings = self.word_embedding(prev_words)
+            if step > 0:
+                prev_word_embeddings = self.word_embedding(prev_words)
             predictions, states, alpha = self.forward_step(
                 encoder_output, prev_word_embeddings, states
             )
@@ -344,42 +531,43 @@ class CaptioningModelDecoder(nn.Module):
             ].clone()
             sorted_indices_to_remove[..., 0] = 0
 
-            top_k_scores = torch.zeros(
-                current_beam_width, dtype=torch.float, device=device
-            )
-            top_k_words = torch.zeros(
-                current_beam_width, dtype=torch.long, device=device
+            # Map the removed tokens back to the vocabulary order and mask them for all
+            # sequences at once
+            indices_to_remove = sorted_indices_to_remove.scatter(
+                1, sorted_indices, sorted_indices_to_remove
             )
+            scores = scores.masked_fill(indices_to_remove, -float("inf"))
 
-            for i in range(0, current_beam_width):
-                scores[i][sorted_indices[i][sorted_indices_to_remove[i]]] = -float(
-                    "inf"
-                )
-
-                # Sample from the scores
-                top_k_words[i] = torch.multinomial(torch.softmax(scores[i], -1), 1)
-                top_k_scores[i] = scores[i][top_k_words[i]]
+            # Sample from the scores
+            top_k_words = torch.multinomial(torch.softmax(scores, -1), 1)
+            top_k_scores = scores.gather(1, top_k_words).squeeze(1)
+            top_k_words = top_k_words.squeeze(1)
 
             # Add new words to sequences
-            top_k_sequences = torch.cat(
-                (top_k_sequences, top_k_words.unsqueeze(1)), dim=1
-            )
+            next_words_list = top_k_words.tolist()
+            top_k_sequences = [
+                sequence + [next_word]
+                for sequence, next_word in zip(top_k_sequences, next_words_list)
+            ]
 
             if print_beam:
                 print_current_beam(top_k_sequences, top_k_scores, self.word_map)
 
-            # Check for complete and incomplete sequences (based on the <end> token)
-            incomplete_inds = (
-                torch.nonzero(top_k_words != self.word_map[TOKEN_END]).view(-1).tolist()
-            )
-            complete_inds = (
-                torch.nonzero(top_k_words == self.word_map[TOKEN_END]).view(-1).tolist()
+            # Check for complete and incomplete sequences (based on the <end> token),
+            # the words are already on the host so the beam width is known without
+            # waiting for the device
+            complete_inds, incomplete_inds = split_ended_sequences(
+                next_words_list, self.word_map[TOKEN_END]
             )
 
             # Set aside complete sequences and reduce beam size accordingly
             if len(complete_inds) > 0:
-                complete_seqs.extend(top_k_sequences[complete_inds].tolist())
-                complete_seqs_scores.extend(top_k_scores[complete_inds])
+                complete_seqs.extend(
+                    sequence
+                    for sequence, next_word in zip(top_k_sequences, next_words_list)
+                    if next_word == self.word_map[TOKEN_END]
+                )
+                complete_seqs_scores.append(top_k_scores[complete_inds])
 
             # Stop if k captions have been completely generated
             current_beam_width = len(incomplete_inds)
@@ -387,22 +575,22 @@ class CaptioningModelDecoder(nn.Module):
                 break
 
             # Proceed with incomplete sequences
-            top_k_sequences = top_k_sequences[incomplete_inds]
-            for i in range(len(states)):
-                states[i] = states[i][incomplete_inds]
-            encoder_output = encoder_output[incomplete_inds]
-            top_k_scores = top_k_scores[incomplete_inds]
+            top_k_sequences = [
+                sequence
+                for sequence, next_word in zip(top_k_sequences, next_words_list)
+                if next_word != self.word_map[TOKEN_END]
+            ]
+            states = [state.index_select(0, incomplete_inds) for state in states]
+            encoder_output = encoder_output.index_select(0, incomplete_inds)
+            top_k_scores = top_k_scores.index_select(0, incomplete_inds)
+            prev_words = top_k_words.index_select(0, incomplete_inds)
 
         if len(complete_seqs) < beam_size:
-            complete_seqs.extend(top_k_sequences.tolist())
-            complete_seqs_scores.extend(top_k_scores)
+            complete_seqs.extend(top_k_sequences)
+            complete_seqs_scores.append(top_k_scores)
 
-        sorted_sequences = [
-            sequence
-            for _, sequence in sorted(
-                zip(complete_seqs_scores, complete_seqs), reverse=True
-            )
-        ]
+        order = sort_order_by_scores(complete_seqs_scores)
+        sorted_sequences = [complete_seqs[i] for i in order]
         return sorted_sequences, None, None
 
 
@@ -424,6 +612,74 @@ def create_decoder_optimizer(decoder, params):
     return optimizer
 
 
+def top_k_sharded(scores, k, num_shards=NUM_VOCABULARY_SHARDS):
+    """
+    Find the top k of the flattened scores in two stages: First the top k within each
+    shard of the vocabulary, then the top k of these candidates. This gives the same
+    result as scores.view(-1).topk(k), but each stage runs on much smaller rows.
+
+    :param scores: scores over the vocabulary, shape: (beam_size, vocab_size) or (vocab_size)
+    :param k: number of scores to find
+    :return: top k scores and their indices in the flattened scores, sorted descending
+    """
+    vocab_size = scores.size(-1)
+    scores = scores.view(-1, vocab_size)
+    shard_size = -(-vocab_size // num_shards)
+
+    # Pad the vocabulary so that it can be split into shards of equal size
+    padding = shard_size * num_shards - vocab_size
+    shards = F.pad(scores, (0, padding), value=-float("inf"))
+    shards = shards.view(scores.size(0), num_shards, shard_size)
+
+    # Top k candidates of every shard: (beam_size, num_shards, k)
+    candidate_scores, candidate_inds = shards.topk(min(k, shard_size), dim=-1)
+    shard_offsets = torch.arange(0, num_shards * shard_size, shard_size, device=device)
+    beam_offsets = torch.arange(0, scores.numel(), vocab_size, device=device)
+    candidate_inds = (
+        candidate_inds + shard_offsets.view(1, -1, 1) + beam_offsets.view(-1, 1, 1)
+    )
+
+    # Top k of all candidates
+    top_k_scores, top_k_candidates = candidate_scores.view(-1).topk(
+        k, 0, largest=True, sorted=True
+    )
+    top_k_inds = candidate_inds.view(-1)[top_k_candidates]
+    return top_k_scores, top_k_inds
+
+
+def split_ended_sequences(words, end_token):
+    """
+    Split the sequences of a beam by whether their last word is the <end> token.
+
+    :param words: list of the last words of all sequences
+    :param end_token: id of the <end> token
+    :return: indices of the complete and of the incomplete sequences on the device
+    """
+    complete_inds = [i for i, word in enumerate(words) if word == end_token]
+    incomplete_inds = [i for i, word in enumerate(words) if word != end_token]
+
+    # Copy both index lists to the device at once
+    inds = torch.tensor(
+        complete_inds + incomplete_inds, dtype=torch.int64, device=device
+    )
+    return inds[: len(complete_inds)], inds[len(complete_inds) :]
+
+
+def sort_order_by_scores(scores):
+    """
+    Find the order of sequences sorted by descending score.
+
+    :param scores: list of tensors with the scores of the sequences
+    :return: list of indices of the sequences
+    """
+    return torch.cat(scores).argsort(descending=True).tolist()
+
+
+def update_decode_lengths(decode_lengths, ended, t):
+    """Set the decode lengths of sequences that ended at timestep t to t."""
+    return decode_lengths.masked_fill(ended & (decode_lengths > t), t)
+
+
 def update_params(defaults, params):
     updated = defaults.copy()
     for key, value in defaults.items():
@@ -435,8 +691,4 @@ def update_params(defaults, params):
 def print_current_beam(top_k_sequences, top_k_scores, word_map):
     print("\n")
     for sequence, score in zip(top_k_sequences, top_k_scores):
-        print(
-            "{} \t\t\t\t Score: {}".format(
-                decode_caption(sequence.cpu().numpy(), word_map), score
-            )
-        )
+        print("{} \t\t\t\t Score: {}".format(decode_caption(sequence, word_map), score))
@@ -40,6 +40,9 @@ class Encoder(nn.Module):
         :param images: input images, shape: (batch_size, 3, image_size, image_size)
         :return: encoded images
         """
+        # The convolutions are faster in the channels last memory format, which also
+        # makes the permuted output contiguous
+        images = images.contiguous(memory_format=torch.channels_last)
         out = self.model(
             images
         )  # output shape: (batch_size, 2048, image_size/32, image_size/32)
@@ -118,21 +121,25 @@ class SATDecoder(CaptioningModelDecoder):
         Create the initial hidden and cell states for the decoder's LSTM based on the encoded images.
 
         :param encoder_out: encoded images, shape: (batch_size, num_pixels, encoder_dim)
-        :return: hidden state, cell state
+        :return: hidden state, cell state, encoded images transformed for the attention
         """
         mean_encoder_out = encoder_out.mean(dim=1)
         h = self.init_h(mean_encoder_out)  # (batch_size, decoder_dim)
         c = self.init_c(mean_encoder_out)
 
-        states = [h, c]
+        # The transformation of the encoded images for the attention is the same for
+        # all timesteps, so it is computed once and passed along with the LSTM states
+        encoder_out_att = self.attention.transform_encoder_out(encoder_out)
+
+        states = [h, c, encoder_out_att]
         return states
 
     def forward_step(self, encoder_output, prev_word_embeddings, states):
         """Perform a single decoding step."""
-        decoder_hidden_state, decoder_cell_state = states
+        decoder_hidden_state, decoder_cell_state, encoder_output_att = states
 
         attention_weighted_encoding, alpha = self.attention(
-            encoder_output, decoder_hidden_state
+            encoder_output, encoder_output_att, decoder_hidden_state
         )
         gating_scalars = self.sigmoid(self.f_beta(decoder_hidden_state))
         attention_weighted_encoding = gating_scalars * attention_weighted_encoding
@@ -156,7 +163,7 @@ class SATDecoder(CaptioningModelDecoder):
             )
         )
 
-        states = [decoder_hidden_state, decoder_cell_state]
+        states = [decoder_hidden_state, decoder_cell_state, encoder_output_att]
         return scores, states, alpha
 
     def loss(self, scores, target_captions, decode_lengths, alphas):
@@ -185,32 +192,38 @@ class AttentionModule(nn.Module):
         # Linear layer to calculate values to be softmax-ed
         self.full_att = nn.Linear(attention_dim, 1)
 
-        # ReLU layer
-        self.relu = nn.ReLU()
-
         # Softmax layer to calculate attention weights
         self.softmax = nn.Softmax(dim=1)
 
-    def forward(self, encoder_out, decoder_hidden):
+    def transform_encoder_out(self, encoder_out):
+        """
+        Transform the encoded images, this does not depend on the decoder output.
+
+        :param encoder_out: encoded images, shape: (batch_size, num_pixels, encoder_dim)
+        :return: transformed encoded images, shape: (batch_size, num_pixels, attention_dim)
+        """
+        return self.encoder_att(encoder_out)
+
+    def forward(self, encoder_out, att1, decoder_hidden):
         """
         Forward propagation.
 
         :param encoder_out: encoded images, shape: (batch_size, num_pixels, encoder_dim)
+        :param att1: encoded images transformed by transform_encoder_out
         :param decoder_hidden: previous decoder output, shape: (batch_size, decoder_dim)
         :return: attention weighted encoding, weights
         """
-        att1 = self.encoder_att(
-            encoder_out
-        )  # output shape: (batch_size, num_pixels, attention_dim)
         att2 = self.decoder_att(
             decoder_hidden
         )  # output shape: (batch_size, attention_dim)
-        att = self.full_att(self.relu(att1 + att2.unsqueeze(1))).squeeze(
+        att = self.full_att(torch.relu_(att1 + att2.unsqueeze(1))).squeeze(
             2
         )  # output shape: (batch_size, num_pixels)
         alpha = self.softmax(att)  # output shape: (batch_size, num_pixels)
-        attention_weighted_encoding = (encoder_out * alpha.unsqueeze(2)).sum(
-            dim=1
-        )  # output shape: (batch_size, encoder_dim)
+        # Weighted sum of the encoding with a batched matrix product instead of a
+        # broadcasted (batch_size, num_pixels, encoder_dim) product
+        attention_weighted_encoding = torch.bmm(
+            alpha.unsqueeze(1), encoder_out
+        ).squeeze(1)  # output shape: (batch_size, encoder_dim)
 
         return attention_weighted_encoding, alpha
@@ -8,8 +8,35 @@ from utils import (
     contains_verb_noun_pair,
     get_objects_for_noun,
     get_objects_for_verb,
+    compact_pos_tagged_caption,
+    TaggedCaption,
 )
 
+# Captions of the tests for pairs, as (caption, nouns, adjectives or verbs)
+ADJECTIVE_NOUN_CAPTIONS = [
+    ("a white car is driving down the street", {"car"}, {"white"}),
+    ("two white cars are driving down the street", {"car"}, {"white"}),
+    ("a white and blue car is driving down the street", {"car"}, {"white"}),
+    ("a white-blue car is driving down the street", {"car"}, {"white"}),
+    ("a blue-white car is driving down the street", {"car"}, {"white"}),
+    ("a white compact-car is driving down the street", {"car"}, {"white"}),
+    ("the car that is driving down the street is white", {"car"}, {"white"}),
+    ("a blue car is driving down the white street", {"car"}, {"white"}),
+    ("person inside display area with a young elephant", {"person"}, {"young"}),
+    (
+        "a gray shaggy dog hanging out the driver side window of a blue minivan.",
+        {"window"},
+        {"blue"},
+    ),
+]
+VERB_NOUN_CAPTIONS = [
+    ("a man sits on a chair.", {"man"}, {"sit"}),
+    ("a man that is sitting on a chair.", {"man"}, {"sit"}),
+    ("a man that sits on a chair.", {"man"}, {"sit"}),
+    ("a man sitting on a chair.", {"man"}, {"sit"}),
+    ("a man is sitting on a chair.", {"man"}, {"sit"}),
+]
+
 
 class UtilsTests(unittest.TestCase):
 
@@ -219,6 +246,43 @@ class UtilsTests(unittest.TestCase):
         ) | get_objects_for_verb(pos_tagged_caption, verbs)
         self.assertEqual({"chair"}, objects)
 
+    def tag_caption(self, caption):
+        """Return the stanfordnlp sentence and its compact version."""
+        sentence = self.nlp_pipeline(caption).sentences[0]
+        return sentence, TaggedCaption(compact_pos_tagged_caption(sentence))
+
+    def test_compact_pos_tagged_caption_adjective_noun_pair(self):
+        for caption, nouns, adjectives in ADJECTIVE_NOUN_CAPTIONS:
+            sentence, compact_caption = self.tag_caption(caption)
+            self.assertEqual(
+                contains_adjective_noun_pair(sentence, nouns, adjectives),
+                contains_adjective_noun_pair(compact_caption, nouns, adjectives),
+                caption,
+            )
+
+    def test_compact_pos_tagged_caption_verb_noun_pair(self):
+        for caption, nouns, verbs in VERB_NOUN_CAPTIONS:
+            sentence, compact_caption = self.tag_caption(caption)
+            self.assertEqual(
+                contains_verb_noun_pair(sentence, nouns, verbs),
+                contains_verb_noun_pair(compact_caption, nouns, verbs),
+                caption,
+            )
+
+    def test_compact_pos_tagged_caption_objects(self):
+        for caption, nouns, others in ADJECTIVE_NOUN_CAPTIONS + VERB_NOUN_CAPTIONS:
+            sentence, compact_caption = self.tag_caption(caption)
+            self.assertEqual(
+                get_objects_for_noun(sentence, nouns),
+                get_objects_for_noun(compact_caption, nouns),
+                caption,
+            )
+            self.assertEqual(
+                get_objects_for_verb(sentence, others),
+                get_objects_for_verb(compact_caption, others),
+                caption,
+            )
+
 
 if __name__ == "__main__":
     unittest.main()
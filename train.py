@@ -2,13 +2,19 @@
 import logging
 
 import argparse
+import concurrent.futures
+import contextlib
 import json
 import os
 import sys
+import tempfile
+import numpy as np
 import torch.backends.cudnn as cudnn
 import torch.optim
 import torch.utils.data
 from torch import nn
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
 from torchvision.transforms import transforms
 
 from eval import evaluate, METRIC_RECALL, METRIC_BLEU
@@ -16,15 +22,22 @@ from models.bottom_up_top_down import TopDownDecoder
 from models.bottom_up_top_down_ranking import BottomUpTopDownRankingDecoder
 from models.captioning_model import create_encoder_optimizer, create_decoder_optimizer
 from models.show_attend_tell import Encoder, SATDecoder
-from datasets import CaptionTrainDataset, CaptionTestDataset
-from nltk.translate.bleu_score import corpus_bleu
+from datasets import (
+    CaptionTrainDataset,
+    CaptionTestDataset,
+    CachedFeaturesTestDataset,
+    DevicePrefetcher,
+    collate_decode_lengths,
+    load_images_meta,
+)
+from metrics import corpus_bleu_parallel, create_process_pool
 
 from utils import (
     save_checkpoint,
     AverageMeter,
     clip_gradients,
     WORD_MAP_FILENAME,
-    get_caption_without_special_tokens,
+    get_captions_without_special_tokens,
     IMAGENET_IMAGES_MEAN,
     IMAGENET_IMAGES_STD,
     BOTTOM_UP_FEATURES_FILENAME,
@@ -50,18 +63,12 @@ def calc_initial_losses(data_loader, encoder, decoder):
     if encoder:
         encoder.train()
 
-    # Do only one batch
-    images, target_captions, caption_lengths = next(iter(data_loader))
-
-    target_captions = target_captions.to(device)
-    caption_lengths = caption_lengths.to(device)
-    images = images.to(device)
+    # Do only one batch, the batch is moved to the device by the loader
+    images, target_captions, decode_lengths = next(iter(data_loader))
 
     # Forward propagation
     if encoder:
         images = encoder(images)
-    decode_lengths = caption_lengths.squeeze(1) - 1
-
     scores, decode_lengths, images_embedded, captions_embedded, alphas = decoder.forward_joint(
         images, target_captions, decode_lengths
     )
@@ -75,69 +82,198 @@ def calc_initial_losses(data_loader, encoder, decoder):
 
 
 def setup_data_loaders(
-    batch_size, data_folder, model_name, train_images_split, val_images_split, workers
+    batch_size,
+    data_folder,
+    model_name,
+    train_images_split,
+    val_images_split,
+    workers,
+    distributed=False,
 ):
+    # The meta data of the images is shared by the datasets, so it is only loaded once
+    images_meta = load_images_meta(data_folder)
+
+    validation_batch_size = batch_size
+    if distributed:
+        # Every process validates its own part of the images, the results are gathered
+        # for the calculation of the metric
+        val_images_split = val_images_split[
+            torch.distributed.get_rank() :: torch.distributed.get_world_size()
+        ]
     if model_name == MODEL_SHOW_ATTEND_TELL:
         normalize = transforms.Normalize(
             mean=IMAGENET_IMAGES_MEAN, std=IMAGENET_IMAGES_STD
         )
-        train_images_loader = torch.utils.data.DataLoader(
-            CaptionTrainDataset(
-                data_folder,
-                IMAGES_FILENAME,
-                train_images_split,
-                transforms.Compose([normalize]),
-                features_scale_factor=1 / 255.0,
-            ),
-            batch_size=batch_size,
-            shuffle=True,
-            num_workers=workers,
-            pin_memory=True,
+        train_dataset = CaptionTrainDataset(
+            data_folder,
+            IMAGES_FILENAME,
+            train_images_split,
+            transforms.Compose([normalize]),
+            features_scale_factor=1 / 255.0,
+            images_meta=images_meta,
         )
-        val_images_loader = torch.utils.data.DataLoader(
-            CaptionTestDataset(
-                data_folder,
-                IMAGES_FILENAME,
-                val_images_split,
-                transforms.Compose([normalize]),
-                features_scale_factor=1 / 255.0,
-            ),
-            batch_size=batch_size,
-            shuffle=True,
-            num_workers=workers,
-            pin_memory=True,
+        val_dataset = CaptionTestDataset(
+            data_folder,
+            IMAGES_FILENAME,
+            val_images_split,
+            transforms.Compose([normalize]),
+            features_scale_factor=1 / 255.0,
+            images_meta=images_meta,
         )
 
     elif (
         model_name == MODEL_BOTTOM_UP_TOP_DOWN
         or model_name == MODEL_BOTTOM_UP_TOP_DOWN_RANKING
     ):
-        train_images_loader = torch.utils.data.DataLoader(
-            CaptionTrainDataset(
-                data_folder, BOTTOM_UP_FEATURES_FILENAME, train_images_split
-            ),
-            batch_size=batch_size,
-            shuffle=True,
-            num_workers=workers,
-            pin_memory=True,
+        train_dataset = CaptionTrainDataset(
+            data_folder,
+            BOTTOM_UP_FEATURES_FILENAME,
+            train_images_split,
+            images_meta=images_meta,
+        )
+        val_dataset = CaptionTestDataset(
+            data_folder,
+            BOTTOM_UP_FEATURES_FILENAME,
+            val_images_split,
+            images_meta=images_meta,
         )
-        validation_batch_size = batch_size
         if model_name == MODEL_BOTTOM_UP_TOP_DOWN_RANKING:
             validation_batch_size = 1
-        val_images_loader = torch.utils.data.DataLoader(
-            CaptionTestDataset(
-                data_folder, BOTTOM_UP_FEATURES_FILENAME, val_images_split
-            ),
-            batch_size=validation_batch_size,
-            shuffle=True,
-            num_workers=workers,
-            pin_memory=True,
-        )
     else:
         raise RuntimeError("Unknown model name: {}".format(model_name))
+
+    # In distributed training, every process trains on its own part of the data
+    train_sampler = DistributedSampler(train_dataset) if distributed else None
+    train_images_loader = torch.utils.data.DataLoader(
+        train_dataset,
+        batch_size=batch_size,
+        shuffle=train_sampler is None,
+        sampler=train_sampler,
+        # The decode lengths are computed in the workers
+        collate_fn=collate_decode_lengths,
+        num_workers=workers,
+        pin_memory=True,
+        # Keep the workers alive between epochs, so that they don't need to be started
+        # and open the dataset files again
+        persistent_workers=workers > 0,
+    )
+    val_images_loader = torch.utils.data.DataLoader(
+        val_dataset,
+        batch_size=validation_batch_size,
+        shuffle=False,
+        num_workers=workers,
+        pin_memory=True,
+        persistent_workers=workers > 0,
+    )
+
+    # Copy the training batches to the device while the previous batch is processed
+    train_images_loader = DevicePrefetcher(train_images_loader, device)
+
     return train_images_loader, val_images_loader
 
 
+def cache_encoder_outputs(data_loader, encoder, autocast_dtype=None):
+    """
+    Encode all images of a test data loader once and create a data loader that provides
+    the encoder outputs instead of the images. The outputs are stored in a memory-mapped
+    temporary file, which is deleted when it is no longer used.
+
+    :param data_loader: data loader of the test dataset, in the order of the dataset
+    :param encoder: encoder
+    :param autocast_dtype: Data type of the forward pass in mixed precision, None to
+        encode in full precision
+    :return: data loader of the encoder outputs
+    """
+    dataset = data_loader.dataset
+    encoder.eval()
+
+    # The outputs are stored in the order of the dataset, which is the order of the
+    # validation data loader
+    encoder_outputs = None
+    start = 0
+    with torch.inference_mode():
+        for images, _, _, _ in data_loader:
+            with torch.autocast(
+                device.type, dtype=autocast_dtype, enabled=autocast_dtype is not None
+            ):
+                outputs = encoder(images.to(device, non_blocking=True)).float().cpu()
+
+            if encoder_outputs is None:
+                encoder_outputs = torch.from_numpy(
+                    np.memmap(
+                        tempfile.TemporaryFile(),
+                        dtype=np.float32,
+                        mode="w+",
+                        shape=(len(dataset),) + tuple(outputs.shape[1:]),
+                    )
+                )
+            encoder_outputs[start : start + len(outputs)] = outputs
+            start += len(outputs)
+
+    # The encoder outputs are read from the memory-mapped file in the main process
+    return torch.utils.data.DataLoader(
+        CachedFeaturesTestDataset(dataset, encoder_outputs),
+        batch_size=data_loader.batch_size,
+        shuffle=False,
+        pin_memory=True,
+    )
+
+
+def get_default_num_workers(model_name):
+    """
+    Choose the number of data loader workers based on the available CPUs.
+
+    :param model_name: name of the model to be trained
+    :return: number of workers per data loader
+    """
+    # Loading pre-extracted bottom-up features is cheap, more workers don't help
+    if model_name != MODEL_SHOW_ATTEND_TELL:
+        return 2
+
+    # The images need to be decoded and normalized, the CPUs are shared between the
+    # processes of all GPUs
+    num_processes = max(1, torch.cuda.device_count())
+    return min(8, max(2, (os.cpu_count() or 2) // num_processes))
+
+
+def init_distributed():
+    """
+    Initialize the process group if the script was launched with torchrun.
+
+    :return: True if the training is distributed over several processes
+    """
+    if int(os.environ.get("WORLD_SIZE", 1)) == 1:
+        return False
+
+    if torch.cuda.is_available():
+        # Every process uses its own GPU, the models refer to it as the current device
+        torch.cuda.set_device(int(os.environ["LOCAL_RANK"]))
+        torch.distributed.init_process_group("nccl")
+    else:
+        torch.distributed.init_process_group("gloo")
+    return True
+
+
+def gradient_sync_context(models, sync):
+    """
+    Create a context in which the gradients of DistributedDataParallel models are only
+    synchronized between the processes if sync is True.
+    """
+    context = contextlib.ExitStack()
+    if not sync:
+        for model in models:
+            if isinstance(model, DistributedDataParallel):
+                context.enter_context(model.no_sync())
+    return context
+
+
+def unwrap_model(model):
+    """Return the model itself if it is wrapped in DistributedDataParallel."""
+    if isinstance(model, DistributedDataParallel):
+        return model.module
+    return model
+
+
 def main(
     model_params,
     model_name,
@@ -154,7 +290,11 @@ def main(
     fine_tune_encoder,
     gradnorm_alpha,
     gradnorm_learning_rate,
-    workers=1,
+    mixed_precision=False,
+    compile_decoder=False,
+    jit_encoder=False,
+    accumulation_steps=1,
+    workers=None,
     start_epoch=0,
     epochs_early_stopping=5,
     checkpoint=None,
@@ -164,6 +304,35 @@ def main(
     best_generation_metric_score = 0.0
     best_ranking_metric_score = 0.0
 
+    distributed = init_distributed()
+    if distributed and objective == OBJECTIVE_JOINT:
+        raise NotImplementedError(
+            "Distributed training is not supported for the joint objective"
+        )
+    is_main_process = not distributed or torch.distributed.get_rank() == 0
+
+    if accumulation_steps > 1 and objective == OBJECTIVE_JOINT:
+        raise NotImplementedError(
+            "Gradient accumulation is not supported for the joint objective"
+        )
+
+    # The forward passes are run in half precision, bfloat16 is preferred if the GPU
+    # supports it, as it has the same range as float32 and the loss does not need to be
+    # scaled
+    autocast_dtype = None
+    if mixed_precision:
+        if objective == OBJECTIVE_JOINT:
+            raise NotImplementedError(
+                "Mixed precision training is not supported for the joint objective"
+            )
+        if device.type == "cuda" and not torch.cuda.is_bf16_supported():
+            autocast_dtype = torch.float16
+        else:
+            autocast_dtype = torch.bfloat16
+    grad_scaler = torch.amp.GradScaler(
+        device.type, enabled=autocast_dtype == torch.float16
+    )
+
     # Get the dataset splits
     dataset_splits_dict = json.load(open(dataset_splits, "r"))
     train_images_split = dataset_splits_dict["train_images_split"]
@@ -258,6 +427,9 @@ def main(
     logging.info("Decoder params: %s", decoder.params)
 
     # Data loaders
+    if workers is None:
+        workers = get_default_num_workers(model_name)
+        logging.info("Using %d data loader workers", workers)
     train_images_loader, val_images_loader = setup_data_loaders(
         batch_size,
         data_folder,
@@ -265,12 +437,49 @@ def main(
         train_images_split,
         val_images_split,
         workers,
+        distributed,
     )
 
     logging.info("Starting training on device: %s", device)
     if encoder:
-        encoder.to(device)
+        encoder.to(device, memory_format=torch.channels_last)
     decoder = decoder.to(device)
+    if compile_decoder:
+        decoder.compile_forward_step()
+
+    # The scripted encoder shares its parameters with the encoder, which is still saved
+    # in the checkpoints as script modules cannot be pickled
+    if jit_encoder and encoder:
+        script_encoder = torch.jit.script(encoder)
+    else:
+        script_encoder = encoder
+
+    # Without fine-tuning, the outputs of the encoder for the validation images don't
+    # change during training, so they are computed once
+    val_encoder = script_encoder
+    if encoder and not encoder_optimizer:
+        logging.info("Caching the encoder outputs for the validation images")
+        val_images_loader = cache_encoder_outputs(
+            val_images_loader, script_encoder, autocast_dtype
+        )
+        val_encoder = None
+
+    # In distributed training the gradients are averaged over all processes during the
+    # backward pass, validation and checkpoints use the unwrapped models
+    train_encoder = script_encoder
+    train_decoder = decoder
+    if distributed:
+        device_ids = [torch.cuda.current_device()] if device.type == "cuda" else None
+        train_decoder = DistributedDataParallel(
+            decoder,
+            device_ids=device_ids,
+            # The caption embedding is only trained with the joint objective
+            find_unused_parameters=model_name == MODEL_BOTTOM_UP_TOP_DOWN_RANKING,
+        )
+        if encoder_optimizer:
+            train_encoder = DistributedDataParallel(
+                script_encoder, device_ids=device_ids
+            )
 
     initial_generation_loss = None
     initial_ranking_loss = None
@@ -278,6 +487,16 @@ def main(
         initial_generation_loss, initial_ranking_loss = calc_initial_losses(
             train_images_loader, encoder, decoder
         )
+    # The checkpoints are written to disk in the background while the next epoch trains
+    checkpoint_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    checkpoint_written = None
+    # The BLEU score is calculated by the main process, in a pool of processes that is
+    # reused in every epoch and shares the CPUs with the pools of the other processes
+    bleu_processes = max(
+        1,
+        os.cpu_count() // (torch.distributed.get_world_size() if distributed else 1),
+    )
+    bleu_executor = create_process_pool(bleu_processes) if is_main_process else None
     for epoch in range(start_epoch, epochs):
         if epochs_since_last_improvement >= epochs_early_stopping:
             logging.info(
@@ -287,18 +506,24 @@ def main(
             )
             break
 
+        if distributed:
+            # Shuffle the data differently in every epoch
+            train_images_loader.data_loader.sampler.set_epoch(epoch)
+
         # One epoch's training
         if objective == OBJECTIVE_GENERATION:
             train(
-                model_name,
                 train_images_loader,
-                encoder,
-                decoder,
+                train_encoder,
+                train_decoder,
                 encoder_optimizer,
                 decoder_optimizer,
                 epoch,
                 grad_clip,
                 print_freq,
+                autocast_dtype,
+                grad_scaler,
+                accumulation_steps,
             )
         elif objective == OBJECTIVE_JOINT:
             train_joint(
@@ -320,7 +545,14 @@ def main(
             )
 
         current_generation_metric_score = validate(
-            val_images_loader, encoder, decoder, word_map, print_freq
+            val_images_loader,
+            val_encoder,
+            decoder,
+            word_map,
+            print_freq,
+            autocast_dtype,
+            bleu_executor,
+            bleu_processes,
         )
         current_checkpoint_is_best = (
             current_generation_metric_score > best_generation_metric_score
@@ -342,23 +574,42 @@ def main(
             )
             logging.info("Best ranking score: {}\n".format(best_ranking_metric_score))
 
-        # Save checkpoint
-        save_checkpoint(
-            model_name,
-            dataset_splits,
-            epoch,
-            epochs_since_last_improvement,
-            encoder,
-            decoder,
-            encoder_optimizer,
-            decoder_optimizer,
-            current_generation_metric_score,
-            current_checkpoint_is_best,
-            name_suffix,
-        )
+        # Save checkpoint, after the previous one has been written
+        if is_main_process:
+            if checkpoint_written:
+                checkpoint_written.result()
+            checkpoint_written = save_checkpoint(
+                model_name,
+                dataset_splits,
+                epoch,
+                epochs_since_last_improvement,
+                encoder,
+                decoder,
+                encoder_optimizer,
+                decoder_optimizer,
+                current_generation_metric_score,
+                current_checkpoint_is_best,
+                name_suffix,
+                checkpoint_executor,
+            )
+
+    # Wait for the last checkpoint, it is loaded for the evaluation
+    if checkpoint_written:
+        checkpoint_written.result()
+    checkpoint_executor.shutdown()
+    if bleu_executor:
+        bleu_executor.shutdown()
 
     logging.info("\n\nFinished training.")
 
+    # All processes leave the process group, the evaluation only runs in the main
+    # process
+    if distributed:
+        torch.distributed.destroy_process_group()
+
+    if not is_main_process:
+        return
+
     logging.info("Evaluating:")
     checkpoint_path = get_checkpoint_file_path(
         model_name, dataset_splits, name_suffix, True
@@ -380,11 +631,11 @@ def main(
         visualize=False,
         print_beam=False,
         print_captions=False,
+        compile_decoder=compile_decoder,
     )
 
 
 def train(
-    model_name,
     data_loader,
     encoder,
     decoder,
@@ -393,66 +644,89 @@ def train(
     epoch,
     grad_clip,
     print_freq,
+    autocast_dtype=None,
+    grad_scaler=None,
+    accumulation_steps=1,
 ):
     """
     Perform one training epoch.
 
+    :param autocast_dtype: Data type of the forward pass in mixed precision training,
+        None to train in full precision
+    :param grad_scaler: Gradient scaler for the loss in float16 training
+    :param accumulation_steps: Number of batches over which the gradients are
+        accumulated before the weights are updated, the last window of the epoch can
+        contain fewer batches
     """
+    if grad_scaler is None:
+        grad_scaler = torch.amp.GradScaler(device.type, enabled=False)
 
     decoder.train()
     if encoder:
-        encoder.train()
+        # An encoder that is not fine-tuned is kept in evaluation mode, so that its
+        # batch normalization statistics are not updated
+        encoder.train(encoder_optimizer is not None)
 
     losses = AverageMeter()
+    num_batches = len(data_loader)
 
-    # Loop over training batches
-    for i, (images, target_captions, caption_lengths) in enumerate(data_loader):
-        target_captions = target_captions.to(device)
-        caption_lengths = caption_lengths.to(device)
-        images = images.to(device)
-
-        # Forward propagation
-        if encoder:
-            images = encoder(images)
-        decode_lengths = caption_lengths.squeeze(1) - 1
+    # Loop over training batches, the batches are moved to the device by the loader
+    for i, (images, target_captions, decode_lengths) in enumerate(data_loader):
+        # The weights are updated after every accumulation_steps batches and after the
+        # last batch of the epoch
+        update_weights = (i + 1) % accumulation_steps == 0 or i + 1 == num_batches
 
-        if model_name == MODEL_BOTTOM_UP_TOP_DOWN_RANKING:
-            scores, decode_lengths, images_embedded, captions_embedded, alphas = decoder.forward_joint(
-                images, target_captions, decode_lengths
-            )
-            loss = decoder.loss(scores, target_captions, decode_lengths, alphas)
+        if i % accumulation_steps == 0:
+            decoder_optimizer.zero_grad(set_to_none=True)
+            if encoder_optimizer:
+                encoder_optimizer.zero_grad(set_to_none=True)
+            # The last window of the epoch can contain fewer batches
+            window_size = min(accumulation_steps, num_batches - i)
+
+        # In distributed training, the gradients are only averaged over the processes
+        # in the backward pass before the weights are updated
+        with gradient_sync_context([encoder, decoder], update_weights):
+            # Forward propagation
+            with torch.autocast(
+                device.type, dtype=autocast_dtype, enabled=autocast_dtype is not None
+            ):
+                if encoder:
+                    images = encoder(images)
+                scores, decode_lengths, alphas = decoder(
+                    images, target_captions, decode_lengths
+                )
+                loss = unwrap_model(decoder).loss(
+                    scores, target_captions, decode_lengths, alphas
+                )
 
-        else:
-            scores, decode_lengths, alphas = decoder(
-                images, target_captions, decode_lengths
-            )
-            loss = decoder.loss(scores, target_captions, decode_lengths, alphas)
+            # The gradients are averaged over the accumulated batches
+            grad_scaler.scale(loss / window_size).backward()
 
-        decoder_optimizer.zero_grad()
-        if encoder_optimizer:
-            encoder_optimizer.zero_grad()
-        loss.backward()
+        if update_weights:
+            # Clip gradients, they need to be unscaled first
+            if grad_clip:
+                grad_scaler.unscale_(decoder_optimizer)
+                clip_gradients(decoder_optimizer, grad_clip)
+                if encoder_optimizer:
+                    grad_scaler.unscale_(encoder_optimizer)
+                    clip_gradients(encoder_optimizer, grad_clip)
 
-        # Clip gradients
-        if grad_clip:
-            clip_gradients(decoder_optimizer, grad_clip)
+            # Update weights, the steps are skipped if the gradients overflowed
+            grad_scaler.step(decoder_optimizer)
             if encoder_optimizer:
-                clip_gradients(encoder_optimizer, grad_clip)
-
-        # Update weights
-        decoder_optimizer.step()
-        if encoder_optimizer:
-            encoder_optimizer.step()
+                grad_scaler.step(encoder_optimizer)
+            grad_scaler.update()
 
-        # Keep track of metrics
-        losses.update(loss.item(), sum(decode_lengths).item())
+        # Keep track of metrics, the loss stays on the device until it is logged, so
+        # that there is no synchronization in every batch
+        losses.update(loss.detach(), decode_lengths.sum())
 
         # Log status
         if i % print_freq == 0:
             logging.info(
                 "Epoch: {0}[Batch {1}/{2}]\t"
                 "Loss: {loss.val:.4f} (Average: {loss.avg:.4f})\t".format(
-                    epoch, i, len(data_loader), loss=losses
+                    epoch, i, num_batches, loss=losses
                 )
             )
 
@@ -488,18 +762,13 @@ def train_joint(
         encoder.train()
 
     losses = AverageMeter()
+    num_batches = len(data_loader)
 
-    # Loop over training batches
-    for i, (images, target_captions, caption_lengths) in enumerate(data_loader):
-        target_captions = target_captions.to(device)
-        caption_lengths = caption_lengths.to(device)
-        images = images.to(device)
-
+    # Loop over training batches, the batches are moved to the device by the loader
+    for i, (images, target_captions, decode_lengths) in enumerate(data_loader):
         # Forward propagation
         if encoder:
             images = encoder(images)
-        decode_lengths = caption_lengths.squeeze(1) - 1
-
         scores, decode_lengths, images_embedded, captions_embedded, alphas = decoder.forward_joint(
             images, target_captions, decode_lengths
         )
@@ -507,9 +776,9 @@ def train_joint(
         loss_ranking = decoder.loss_ranking(images_embedded, captions_embedded)
         loss = loss_weights[0] * loss_generation + loss_weights[1] * loss_ranking
 
-        decoder_optimizer.zero_grad()
+        decoder_optimizer.zero_grad(set_to_none=True)
         if encoder_optimizer:
-            encoder_optimizer.zero_grad()
+            encoder_optimizer.zero_grad(set_to_none=True)
         loss.backward(retain_graph=True)
 
         # Get the gradients of the shared layers and calculate their l2-norm
@@ -548,7 +817,7 @@ def train_joint(
         Lgrad = torch.add(gradnorm_loss(G1, C1.data), gradnorm_loss(G2, C2.data))
 
         # Backprop and perform an optimization step
-        gradnorm_optimizer.zero_grad()
+        gradnorm_optimizer.zero_grad(set_to_none=True)
         Lgrad.backward()
         gradnorm_optimizer.step()
 
@@ -563,8 +832,10 @@ def train_joint(
         if encoder_optimizer:
             encoder_optimizer.step()
 
-        # Keep track of metrics
-        losses.update(loss.item(), sum(decode_lengths).item())
+        # Keep track of metrics, the loss stays on the device until it is logged, so
+        # that there is no synchronization in every batch. It has the shape (1,) of the
+        # loss weights and is squeezed into a scalar, so that it can be formatted
+        losses.update(loss.detach().squeeze(), decode_lengths.sum())
 
         # Log status
         if i % print_freq == 0:
@@ -573,7 +844,7 @@ def train_joint(
                 "Loss: {loss.val:.4f} (Average: {loss.avg:.4f})\t Loss weights: Generation: {3:.4f} Ranking: {4:.4f}".format(
                     epoch,
                     i,
-                    len(data_loader),
+                    num_batches,
                     loss_weights[0].item(),
                     loss_weights[1].item(),
                     loss=losses,
@@ -587,52 +858,103 @@ def train_joint(
     logging.info("\n * LOSS - {loss.avg:.3f}\n".format(loss=losses))
 
 
-def validate(data_loader, encoder, decoder, word_map, print_freq):
+def validate(
+    data_loader,
+    encoder,
+    decoder,
+    word_map,
+    print_freq,
+    autocast_dtype=None,
+    bleu_executor=None,
+    bleu_processes=None,
+):
     """
     Perform validation of one training epoch.
 
+    :param autocast_dtype: Data type of the forward pass in mixed precision training,
+        None to validate in full precision
+    :param bleu_executor: Process pool to calculate the BLEU score in, only used by the
+        main process in distributed training
+    :param bleu_processes: Number of processes of the pool
     """
     decoder.eval()
     if encoder:
         encoder.eval()
+        if isinstance(encoder, torch.jit.ScriptModule):
+            # The current weights are frozen into the graph as constants, so that
+            # batch normalization can be folded into the convolutions
+            encoder = torch.jit.freeze(encoder)
 
     target_captions = []
     generated_captions = []
     coco_ids = []
+    num_batches = len(data_loader)
+
+    # Disable gradient computation, the forward passes are only used for inference
+    with torch.inference_mode():
+        # Loop over batches
+        for i, (images, all_captions_for_image, _, coco_id) in enumerate(data_loader):
+            images = images.to(device, non_blocking=True)
+
+            # Forward propagation
+            with torch.autocast(
+                device.type, dtype=autocast_dtype, enabled=autocast_dtype is not None
+            ):
+                if encoder:
+                    images = encoder(images)
+                scores, _, _ = decoder(images, store_alphas=False)
+
+            if i % print_freq == 0:
+                logging.info("Validation: [Batch {0}/{1}]\t".format(i, num_batches))
+
+            # Target captions, the captions of all images are processed at once and
+            # then grouped by image
+            num_captions_per_image = all_captions_for_image.size(1)
+            img_captions = get_captions_without_special_tokens(
+                all_captions_for_image.flatten(0, 1), word_map
+            )
+            for j in range(0, len(img_captions), num_captions_per_image):
+                target_captions.append(img_captions[j : j + num_captions_per_image])
 
-    # Loop over batches
-    for i, (images, all_captions_for_image, _, coco_id) in enumerate(data_loader):
-        images = images.to(device)
-
-        # Forward propagation
-        if encoder:
-            images = encoder(images)
-        scores, decode_lengths, alphas = decoder(images)
-
-        if i % print_freq == 0:
-            logging.info("Validation: [Batch {0}/{1}]\t".format(i, len(data_loader)))
-
-        # Target captions
-        for j in range(all_captions_for_image.shape[0]):
-            img_captions = [
-                get_caption_without_special_tokens(caption, word_map)
-                for caption in all_captions_for_image[j].tolist()
-            ]
-            target_captions.append(img_captions)
-
-        # Generated captions
-        _, captions = torch.max(scores, dim=2)
-        captions = [
-            get_caption_without_special_tokens(caption, word_map)
-            for caption in captions.tolist()
-        ]
-        generated_captions.extend(captions)
+            # Generated captions
+            _, captions = torch.max(scores, dim=2)
+            generated_captions.extend(
+                get_captions_without_special_tokens(captions, word_map)
+            )
 
-        coco_ids.append(coco_id[0])
+            coco_ids.append(coco_id[0])
 
-        assert len(target_captions) == len(generated_captions)
+            assert len(target_captions) == len(generated_captions)
 
-    bleu4 = corpus_bleu(target_captions, generated_captions)
+    if torch.distributed.is_initialized():
+        # Gather the captions of the images that were validated by the other processes
+        # in the main process, which calculates the BLEU score for all of them
+        is_main_process = torch.distributed.get_rank() == 0
+        all_captions = [None] * torch.distributed.get_world_size()
+        torch.distributed.gather_object(
+            (target_captions, generated_captions),
+            all_captions if is_main_process else None,
+            dst=0,
+        )
+        bleu4 = [None]
+        if is_main_process:
+            target_captions = [c for targets, _ in all_captions for c in targets]
+            generated_captions = [c for _, generated in all_captions for c in generated]
+            bleu4[0] = corpus_bleu_parallel(
+                target_captions,
+                generated_captions,
+                processes=bleu_processes,
+                executor=bleu_executor,
+            )
+        torch.distributed.broadcast_object_list(bleu4, src=0)
+        bleu4 = bleu4[0]
+    else:
+        bleu4 = corpus_bleu_parallel(
+            target_captions,
+            generated_captions,
+            processes=bleu_processes,
+            executor=bleu_executor,
+        )
 
     logging.info("\n * BLEU-4 - {bleu}\n".format(bleu=bleu4))
 
@@ -740,6 +1062,37 @@ def check_args(args):
         default=0.01,
     )
 
+    parser.add_argument(
+        "--mixed-precision",
+        help="Train in mixed precision (bfloat16 or float16)",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--accumulation-steps",
+        help="Number of batches over which the gradients are accumulated before "
+        "updating the weights, the last update of an epoch averages the gradients "
+        "over the remaining batches if there are fewer",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--workers",
+        help="Number of data loader workers (chosen based on the CPU count by default)",
+        type=int,
+    )
+    parser.add_argument(
+        "--compile",
+        help="Compile the forward step of the decoder with torch.compile",
+        dest="compile_decoder",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--jit-encoder",
+        help="Compile the encoder with TorchScript",
+        action="store_true",
+    )
+
     parsed_args = parser.parse_args(args)
     return parsed_args
 
@@ -753,7 +1106,8 @@ if __name__ == "__main__":
             parsed_args.name_suffix,
             parsed_args.embeddings,
         ),
-        level=logging.INFO,
+        # Only the first process logs its progress in distributed training
+        level=logging.INFO if int(os.environ.get("RANK", 0)) == 0 else logging.WARNING,
     )
     logging.info(parsed_args)
     main(
@@ -773,4 +1127,9 @@ if __name__ == "__main__":
         fine_tune_encoder=parsed_args.fine_tune_encoder,
         gradnorm_alpha=parsed_args.gradnorm_alpha,
         gradnorm_learning_rate=parsed_args.gradnorm_learning_rate,
+        mixed_precision=parsed_args.mixed_precision,
+        compile_decoder=parsed_args.compile_decoder,
+        jit_encoder=parsed_args.jit_encoder,
+        accumulation_steps=parsed_args.accumulation_steps,
+        workers=parsed_args.workers,
     )
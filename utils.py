@@ -1,8 +1,12 @@
 """General utility functions and variables"""
 
+import io
 import json
 import logging
 import os
+import pickle
+from collections import namedtuple
+from functools import lru_cache
 
 import torch
 
@@ -26,12 +30,15 @@ WORD_MAP_FILENAME = "word_map.json"
 IMAGES_FILENAME = "images.hdf5"
 TEST_IMAGES_FILENAME = "images_coco_test.hdf5"
 BOTTOM_UP_FEATURES_FILENAME = "bottom_up_features.hdf5"
+BOTTOM_UP_FEATURES_INDICES_FILENAME = "bottom_up_features_indices.p"
 IMAGES_META_FILENAME = "images_meta.json"
 POS_TAGGED_CAPTIONS_FILENAME = "pos_tagged_captions.p"
 
 DATA_CAPTIONS = "captions"
 DATA_CAPTION_LENGTHS = "caption_lengths"
 DATA_COCO_SPLIT = "coco_split"
+DATA_IMAGE_FEATURES = "image_features"
+DATA_IMAGE_BB = "image_bb"
 
 
 NOUNS = "nouns"
@@ -194,6 +201,79 @@ def contains_verb_noun_pair(pos_tagged_caption, nouns, verbs):
     return noun_is_present, verb_is_present, combination_is_present
 
 
+def pos_tag_captions(nlp_pipeline, captions):
+    """
+    POS-tag a list of tokenized captions in a single pass of the pipeline.
+
+    :param nlp_pipeline: stanfordnlp pipeline, created with tokenize_pretokenized=True
+    :param captions: list of captions, each given as a list of words
+    :return: list of tagged sentences, one for each caption
+    """
+    doc = nlp_pipeline("\n".join([" ".join(caption) for caption in captions]))
+    assert len(doc.sentences) == len(captions)
+    return doc.sentences
+
+
+TaggedWord = namedtuple(
+    "TaggedWord", ["text", "lemma", "upos", "governor", "dependency_relation"]
+)
+
+# Governor of the root word of a sentence (mirrors the ROOT word of stanfordnlp)
+ROOT_WORD = TaggedWord("ROOT", "_", "_", -1, "_")
+
+
+def compact_pos_tagged_caption(sentence):
+    """Reduce a stanfordnlp sentence to the word annotations needed to find pairs."""
+    return [
+        (word.text, word.lemma, word.upos, word.governor, word.dependency_relation)
+        for word in sentence.words
+    ]
+
+
+class TaggedCaption(object):
+    """Lightweight stand-in for a stanfordnlp sentence, built from a compact caption."""
+
+    def __init__(self, compact_caption):
+        self.words = [TaggedWord(*word) for word in compact_caption]
+        self.tokens = self.words
+        self.dependencies = [
+            (
+                self.words[word.governor - 1] if word.governor > 0 else ROOT_WORD,
+                word.dependency_relation,
+                word,
+            )
+            for word in self.words
+        ]
+
+
+def load_pos_tagged_captions(preprocessed_data_folder):
+    """
+    Load the POS-tagged captions and check that they are stored as compact captions.
+
+    :param preprocessed_data_folder: folder where the preprocessed data is located
+    :return: POS-tagged captions for every coco id
+    """
+    with open(
+        os.path.join(preprocessed_data_folder, POS_TAGGED_CAPTIONS_FILENAME), "rb"
+    ) as pickle_file:
+        captions = pickle.load(pickle_file)
+
+    # Older versions stored stanfordnlp sentences instead of lists of word annotations
+    first_image = next(iter(captions.values()), None)
+    if first_image and not all(
+        isinstance(caption, list) for caption in first_image["pos_tagged_captions"]
+    ):
+        raise RuntimeError(
+            "The POS-tagged captions in {} are stored in an outdated format, "
+            "regenerate the POS-tagged captions with "
+            "data_preprocessing_utils/pos_tag_captions.py".format(
+                preprocessed_data_folder
+            )
+        )
+
+    return captions
+
+
 def read_image(path):
     img = imread(path)
     if len(img.shape) == 2:  # b/w image
@@ -215,6 +295,18 @@ def invert_normalization(image):
     return inv_normalize(image)
 
 
+@lru_cache(maxsize=4)
+def load_occurrences_data(occurrences_data_file):
+    """
+    Load the occurrences data of a concept pair. The parsed data is cached, as the same
+    (large) files are read by several of the metrics.
+
+    The same dict is returned to every caller, so it must not be modified.
+    """
+    with open(occurrences_data_file, "r") as json_file:
+        return json.load(json_file)
+
+
 def get_splits_from_occurrences_data(heldout_pairs):
     occurrences_data_files = [
         os.path.join(base_dir, "data", "occurrences", pair + ".json")
@@ -224,8 +316,7 @@ def get_splits_from_occurrences_data(heldout_pairs):
     val_images_split = set()
 
     for file in occurrences_data_files:
-        with open(file, "r") as json_file:
-            occurrences_data = json.load(json_file)
+        occurrences_data = load_occurrences_data(file)
 
         test_images_split |= {
             key
@@ -238,8 +329,7 @@ def get_splits_from_occurrences_data(heldout_pairs):
             if value[PAIR_OCCURENCES] >= 1 and value[DATA_COCO_SPLIT] == "train2014"
         }
 
-    with open(occurrences_data_files[0], "r") as json_file:
-        occurrences_data = json.load(json_file)
+    occurrences_data = load_occurrences_data(occurrences_data_files[0])
 
     train_images_split = {
         key
@@ -256,20 +346,60 @@ def show_img(img):
     plt.show()
 
 
+# Reverse word map of the most recently decoded word map: (word_map, rev_word_map)
+rev_word_map_cache = (None, None)
+
+
+def get_rev_word_map(word_map):
+    """Return the mapping from indices to words (only rebuilt for a new word map)."""
+    global rev_word_map_cache
+    cached_word_map, rev_word_map = rev_word_map_cache
+    if cached_word_map is not word_map or len(rev_word_map) != len(word_map):
+        rev_word_map = {v: k for k, v in word_map.items()}
+        rev_word_map_cache = (word_map, rev_word_map)
+    return rev_word_map
+
+
 def decode_caption(encoded_caption, word_map):
-    rev_word_map = {v: k for k, v in word_map.items()}
+    rev_word_map = get_rev_word_map(word_map)
     return [rev_word_map[ind] for ind in encoded_caption]
 
 
 def get_caption_without_special_tokens(caption, word_map):
     """Remove start, end and padding tokens from and encoded caption."""
+    special_tokens = {
+        word_map[TOKEN_START],
+        word_map[TOKEN_END],
+        word_map[TOKEN_PADDING],
+    }
 
-    return [
-        token
-        for token in caption
-        if token
-        not in {word_map[TOKEN_START], word_map[TOKEN_END], word_map[TOKEN_PADDING]}
-    ]
+    return [token for token in caption if token not in special_tokens]
+
+
+def get_captions_without_special_tokens(captions, word_map):
+    """
+    Remove start, end and padding tokens from a batch of encoded captions. The tokens
+    are filtered with a mask, so only the remaining tokens are converted to a list.
+
+    :param captions: encoded captions, shape: (num_captions, max_caption_len)
+    :param word_map: word map
+    :return: list of encoded captions without special tokens
+    """
+    special_tokens = torch.tensor(
+        [word_map[TOKEN_START], word_map[TOKEN_END], word_map[TOKEN_PADDING]],
+        device=captions.device,
+    )
+    mask = ~torch.isin(captions, special_tokens)
+
+    tokens = captions[mask].tolist()
+    lengths = mask.sum(dim=1).tolist()
+
+    captions_without_special_tokens = []
+    start = 0
+    for length in lengths:
+        captions_without_special_tokens.append(tokens[start : start + length])
+        start += length
+    return captions_without_special_tokens
 
 
 def clip_gradients(optimizer, grad_clip):
@@ -341,9 +471,11 @@ def save_checkpoint(
     generation_metric_score,
     is_best,
     name_suffix,
+    executor=None,
 ):
     """
-    Save a model checkpoint.
+    Save a model checkpoint. The checkpoint is serialized immediately, but if an
+    executor is given, it is written to disk in the background.
 
     :param epoch: epoch number
     :param epochs_since_improvement: number of epochs since last improvement
@@ -353,6 +485,8 @@ def save_checkpoint(
     :param decoder_optimizer: optimizer to update the decoder's weights
     :param validation_metric_score: validation set score for this epoch
     :param is_best: True, if this is the best checkpoint so far (will save the model to a dedicated file)
+    :param executor: executor to write the checkpoint files with
+    :return: future of the writing if an executor is given, else None
     """
     state = {
         "model_name": model_name,
@@ -364,19 +498,42 @@ def save_checkpoint(
         "encoder_optimizer": encoder_optimizer,
         "decoder_optimizer": decoder_optimizer,
     }
-    file_name = get_checkpoint_file_path(model_name, dataset_splits, name_suffix, False)
-    torch.save(state, file_name)
+    file_names = [
+        get_checkpoint_file_path(model_name, dataset_splits, name_suffix, False)
+    ]
 
     # If this checkpoint is the best so far, store a copy so it doesn't get overwritten by a worse checkpoint
     if is_best:
-        file_name = get_checkpoint_file_path(
-            model_name, dataset_splits, name_suffix, True
+        file_names.append(
+            get_checkpoint_file_path(model_name, dataset_splits, name_suffix, True)
         )
-        torch.save(state, file_name)
+
+    # Serialize the state before the training continues and changes the weights
+    buffer = io.BytesIO()
+    torch.save(state, buffer)
+
+    if executor:
+        return executor.submit(write_checkpoint_files, buffer, file_names)
+    write_checkpoint_files(buffer, file_names)
+
+
+def write_checkpoint_files(buffer, file_names):
+    """
+    Write a serialized checkpoint to files.
+
+    :param buffer: buffer containing the serialized checkpoint
+    :param file_names: names of the files
+    """
+    for file_name in file_names:
+        with open(file_name, "wb") as checkpoint_file:
+            checkpoint_file.write(buffer.getbuffer())
 
 
 class AverageMeter(object):
-    """Class to keep track of most recent, average, sum, and count of a metric."""
+    """
+    Class to keep track of most recent, average, sum, and count of a metric. The values
+    can also be tensors, which are only copied to the host when they are formatted.
+    """
 
     def __init__(self):
         self.reset()